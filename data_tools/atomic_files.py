@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from os.path import basename, dirname
+
+
+def fsync_directory(directory):
+    """Make the renames done in a folder durable."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_path(path, fsync=True):
+    """Write a file under a unique temporary name and rename it over path.
+
+    Readers never see a partially written file, and concurrent writers (threads,
+    processes or machines sharing the folder) never share a temporary file. If the
+    block raises, the temporary file is removed and path is left untouched.
+
+    Parameters
+    ----------
+    path: str
+        Final path of the file.
+    fsync: bool (default=True)
+        If True, the file and its folder are fsynced, so the rename survives a crash.
+
+    Return
+    ------
+    temporary_path: str
+        Path to write to, e.g. with DataFrame.to_parquet or pq.ParquetWriter. It is
+        hidden and ends with ".tmp", so the globs over the output do not see it.
+    """
+    directory = dirname(path) or "."
+    fd, temporary_path = tempfile.mkstemp(prefix=f".{basename(path)}.", suffix=".tmp",
+                                          dir=directory)
+    os.close(fd)
+    try:
+        yield temporary_path
+        if fsync:
+            fd = os.open(temporary_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
+    if fsync:
+        fsync_directory(directory)
+
+
+def write_bytes_atomic(path, body, fsync=True):
+    """Write bytes to a file atomically, see atomic_path."""
+    with atomic_path(path, fsync=fsync) as temporary_path:
+        with open(temporary_path, 'wb') as file:
+            file.write(body)
+
+
+def write_json_atomic(path, data, fsync=True, **dump_kwargs):
+    """Write a json atomically, see atomic_path.
+
+    Parameters
+    ----------
+    path: str
+        Path of the json.
+    data: object
+        Json data.
+    fsync: bool (default=True)
+        See atomic_path.
+    dump_kwargs:
+        Passed to json.dump, e.g. indent.
+    """
+    with atomic_path(path, fsync=fsync) as temporary_path:
+        with open(temporary_path, 'w') as file:
+            json.dump(data, file, **dump_kwargs)
@@ -0,0 +1,85 @@
+import argparse
+from time import perf_counter
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from compact_parquet import list_daily_files, list_structured_files
+
+
+def row_groups_to_scan(paths, origin, destination):
+    """Count the row groups whose statistics can hold the route.
+
+    Parameters
+    ----------
+    paths: list[str]
+        Parquet files.
+    origin: str
+        Origin airport code.
+    destination: str
+        Destination airport code.
+
+    Return
+    ------
+    to_scan: int
+        Row groups a reader has to decode.
+    total: int
+        Row groups in the files.
+    """
+    to_scan, total = 0, 0
+    for path in paths:
+        metadata = pq.ParquetFile(path).metadata
+        names = [metadata.schema.column(index).name for index in range(metadata.num_columns)]
+        origin_index = names.index("origin_code")
+        destination_index = names.index("destination_code")
+        for row_group in range(metadata.num_row_groups):
+            total += 1
+            may_match = True
+            for index, value in [(origin_index, origin), (destination_index, destination)]:
+                statistics = metadata.row_group(row_group).column(index).statistics
+                if statistics is not None and statistics.has_min_max:
+                    may_match = may_match and statistics.min <= value <= statistics.max
+            to_scan += may_match
+    return to_scan, total
+
+
+def time_scan(paths, origin, destination, flight_days):
+    """Read one route and flight day range, returning the rows and the seconds spent."""
+    route_filter = ((ds.field("origin_code") == origin)
+                    & (ds.field("destination_code") == destination)
+                    & (ds.field("flight_day") >= flight_days[0])
+                    & (ds.field("flight_day") <= flight_days[1]))
+    start = perf_counter()
+    table = ds.dataset(paths, format="parquet").to_table(filter=route_filter)
+    return table.num_rows, perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare a route scan over the daily files and over the compacted files."
+    )
+    parser.add_argument("--structured-dir", default="/home/mborges/structured_data")
+    parser.add_argument("--origin", default="GRU")
+    parser.add_argument("--destination", default="POA")
+    parser.add_argument("--flight-days", nargs=2, default=["2023-06-01", "2023-06-07"])
+    args = parser.parse_args()
+
+    # Before: every daily file still on disk, so run it before the superseded files are deleted
+    daily_paths = [f"{args.structured_dir}/{file_name}"
+                   for file_names in list_daily_files(args.structured_dir).values()
+                   for file_name in file_names]
+    # After: what a reader scans once the compaction is in the manifest
+    compacted_paths = sorted({path for paths in list_structured_files(args.structured_dir).values()
+                              for path in paths})
+
+    for label, paths in [("daily", daily_paths), ("compacted", compacted_paths)]:
+        if len(paths) == 0:
+            print(f"{label}: no files")
+            continue
+        to_scan, total = row_groups_to_scan(paths, args.origin, args.destination)
+        rows, seconds = time_scan(paths, args.origin, args.destination, args.flight_days)
+        print(f"{label:>9}: {len(paths)} files, row groups to scan {to_scan}/{total}, "
+              f"{rows} rows in {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
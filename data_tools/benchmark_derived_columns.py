@@ -0,0 +1,124 @@
+import argparse
+import re
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from derived_columns import add_derived_columns
+
+
+def make_day_table(n_rows, seed=0):
+    """Build a synthetic table with the string columns of one day of the wide schema.
+
+    Parameters
+    ----------
+    n_rows: int
+        Number of rows.
+    seed: int (default=0)
+        Seed of the random generator.
+
+    Return
+    ------
+    day_table: pd.DataFrame
+        Columns travelDuration, departureTimeRaw, arrivalTimeRaw and durationInSeconds.
+    """
+    rng = np.random.default_rng(seed)
+    offsets = ["-03:00", "-04:00", "-05:00"]
+    base = datetime(2023, 5, 5, 6, 0)
+    rows = list()
+    for _ in range(n_rows):
+        n_segments = int(rng.integers(1, 4))
+        departure = base + timedelta(minutes=int(rng.integers(0, 60 * 24)))
+        departures, arrivals, durations = list(), list(), list()
+        for _ in range(n_segments):
+            duration = int(rng.integers(45, 300)) * 60
+            arrival = departure + timedelta(seconds=duration)
+            offset = offsets[int(rng.integers(0, len(offsets)))]
+            departures.append(departure.strftime("%Y-%m-%dT%H:%M:%S.000") + offset)
+            arrivals.append(arrival.strftime("%Y-%m-%dT%H:%M:%S.000") + offset)
+            durations.append(str(duration))
+            departure = arrival + timedelta(minutes=int(rng.integers(30, 240)))
+        total_minutes = int(rng.integers(45, 60 * 30))
+        rows.append({"travelDuration": f"PT{total_minutes // 60}H{total_minutes % 60}M",
+                     "departureTimeRaw": "||".join(departures),
+                     "arrivalTimeRaw": "||".join(arrivals),
+                     "durationInSeconds": "||".join(durations)})
+    return pd.DataFrame(rows)
+
+
+def _parse_row(row):
+    """Parse one row the way the analysis notebooks do."""
+    match = re.match(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?)?$", row["travelDuration"])
+    days, hours, minutes = (int(group) if group else 0 for group in match.groups())
+    departures = row["departureTimeRaw"].split("||")
+    arrivals = row["arrivalTimeRaw"].split("||")
+    first_departure = datetime.fromisoformat(departures[0]).astimezone(timezone.utc)
+    last_arrival = datetime.fromisoformat(arrivals[-1]).astimezone(timezone.utc)
+    flight_minutes = sum(int(value) for value in row["durationInSeconds"].split("||")) / 60
+    elapsed_minutes = (last_arrival - first_departure).total_seconds() / 60
+    return pd.Series({"travelDurationMinutes": days * 24 * 60 + hours * 60 + minutes,
+                      "segmentsCount": len(departures),
+                      "firstDepartureUtc": first_departure,
+                      "lastArrivalUtc": last_arrival,
+                      "flightMinutes": flight_minutes,
+                      "layoverMinutes": elapsed_minutes - flight_minutes})
+
+
+def add_derived_columns_rowwise(day_table):
+    """Row by row reference implementation of add_derived_columns."""
+    return pd.concat([day_table, day_table.apply(_parse_row, axis="columns")], axis="columns")
+
+
+def check_known_values():
+    """Check add_derived_columns on hand-computed rows, including multi-digit segments."""
+    day_table = pd.DataFrame({
+        "travelDuration": ["PT4H30M", "PT1H", "P1DT2H"],
+        "departureTimeRaw": ["2023-05-05T06:00:00.000-03:00||2023-05-05T08:30:00.000-03:00",
+                             "2023-05-05T10:00:00.000-03:00",
+                             "2023-05-05T10:00:00.000-03:00||None"],
+        "arrivalTimeRaw": ["2023-05-05T08:00:00.000-03:00||2023-05-05T10:30:00.000-03:00",
+                           "2023-05-05T11:00:00.000-03:00",
+                           "2023-05-05T11:00:00.000-03:00||2023-05-06T12:00:00.000-03:00"],
+        "durationInSeconds": ["7200||7200", "3600", "3600||None"],
+    })
+    derived = add_derived_columns(day_table, schema_name="wide")
+    assert derived["travelDurationMinutes"].tolist() == [270, 60, 1560]
+    assert derived["segmentsCount"].tolist() == [2, 1, 2]
+    assert derived["flightMinutes"].tolist() == [240, 60, 60]
+    assert derived["layoverMinutes"].tolist() == [30, 0, 1500]
+    assert derived["firstDepartureUtc"].tolist() == [pd.Timestamp("2023-05-05T09:00:00Z"),
+                                                     pd.Timestamp("2023-05-05T13:00:00Z"),
+                                                     pd.Timestamp("2023-05-05T13:00:00Z")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare vectorized and row-wise parsing.")
+    parser.add_argument("--rows", type=int, default=200_000,
+                        help="rows of the synthetic day table")
+    args = parser.parse_args()
+
+    check_known_values()
+    day_table = make_day_table(args.rows)
+    print(f"{len(day_table)} rows")
+
+    start = perf_counter()
+    vectorized = add_derived_columns(day_table.copy(), schema_name="wide")
+    vectorized_seconds = perf_counter() - start
+    print(f"vectorized: {vectorized_seconds:.2f}s")
+
+    start = perf_counter()
+    rowwise = add_derived_columns_rowwise(day_table.copy())
+    rowwise_seconds = perf_counter() - start
+    print(f"row-wise:   {rowwise_seconds:.2f}s")
+    print(f"speedup:    {rowwise_seconds / vectorized_seconds:.1f}x")
+
+    for column in ["travelDurationMinutes", "segmentsCount", "flightMinutes", "layoverMinutes"]:
+        assert np.allclose(vectorized[column].astype("float64"), rowwise[column].astype("float64")), column
+    for column in ["firstDepartureUtc", "lastArrivalUtc"]:
+        assert (vectorized[column] == pd.to_datetime(rowwise[column], utc=True)).all(), column
+    print("Both approaches give the same values")
+
+
+if __name__ == "__main__":
+    main()
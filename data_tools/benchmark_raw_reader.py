@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+from glob import glob
+from time import perf_counter, process_time
+
+from raw_reader import orjson, prefetch_ahead, read_json
+
+
+def drop_from_cache(paths):
+    """Evict the files from the page cache, so the next read comes from disk.
+
+    Only clean pages are evicted, which is the case of files written long ago.
+    """
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+# The readers return the number of files that are not a json (empty or truncated),
+# which the extractors log as "Unable to read json file" and skip
+def read_text(paths):
+    failed = 0
+    for path in paths:
+        with open(path, 'r') as file:
+            try:
+                json.load(file)
+            except ValueError:
+                failed += 1
+    return failed
+
+
+def read_mapped(paths):
+    failed = 0
+    for path in paths:
+        try:
+            read_json(path)
+        except ValueError:
+            failed += 1
+    return failed
+
+
+def read_mapped_prefetched(paths):
+    failed = 0
+    for path in prefetch_ahead(paths):
+        try:
+            read_json(path)
+        except ValueError:
+            failed += 1
+    return failed
+
+
+def measure(reader, paths):
+    """Time one reader on a cold cache.
+
+    Return
+    ------
+    wall: float
+        Elapsed seconds.
+    cpu: float
+        CPU seconds of this process; the rest of the wall time is spent waiting on I/O.
+    failed: int
+        Files that could not be parsed.
+    """
+    drop_from_cache(paths)
+    wall_start, cpu_start = perf_counter(), process_time()
+    failed = reader(paths)
+    return perf_counter() - wall_start, process_time() - cpu_start, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare I/O wait and CPU time of the raw file readers on a cold cache."
+    )
+    parser.add_argument("--day-dir", default="/home/mborges/data/today_2023-05-01",
+                        help="folder of one collected day")
+    parser.add_argument("--limit", type=int, default=None, help="read only the first files")
+    args = parser.parse_args()
+
+    paths = sorted(glob(os.path.join(args.day_dir, "*", "*", "*.json")))[:args.limit]
+    size_mb = sum(os.path.getsize(path) for path in paths) / 1024**2
+    print(f"{len(paths)} files, {size_mb:.0f} MB, parser: {'orjson' if orjson else 'json'}")
+
+    for label, reader in [("open + json.load", read_text),
+                          ("mmap", read_mapped),
+                          ("mmap + prefetch", read_mapped_prefetched)]:
+        wall, cpu, failed = measure(reader, paths)
+        print(f"{label:>16}: wall {wall:.2f}s, cpu {cpu:.2f}s, "
+              f"io wait {max(wall - cpu, 0):.2f}s ({size_mb / wall:.0f} MB/s), "
+              f"{failed} unreadable files")
+
+
+if __name__ == "__main__":
+    main()
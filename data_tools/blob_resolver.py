@@ -0,0 +1,44 @@
+from os.path import dirname, join, normpath
+
+from raw_reader import read_json
+
+
+def is_blob_reference(data):
+    """Checks if a json is a reference to a deduplicated body (see scrape/blob_store.py).
+
+    Parameters
+    ----------
+    data: dict
+        Json data.
+
+    Return
+    ------
+    is_reference: bool
+        True if data only points to a blob.
+    """
+    return isinstance(data, dict) and "blob_ref" in data and "blob_path" in data
+
+
+def resolve_blob_reference(data, json_path):
+    """Replace a blob reference by the full response.
+
+    Parameters
+    ----------
+    data: dict
+        Json data read from json_path. If it is not a reference, it is returned as is.
+    json_path: str
+        Path of the json, the blob path is relative to its folder.
+
+    Return
+    ------
+    data: dict
+        The stored response with the search_time of the reference and the
+        "blob_ref" key, which identifies identical responses.
+    """
+    if not is_blob_reference(data):
+        return data
+    blob_path = normpath(join(dirname(json_path), data["blob_path"]))
+    resolved_data = read_json(blob_path)
+    resolved_data["search_time"] = data.get("search_time")
+    resolved_data["blob_ref"] = data["blob_ref"]
+    return resolved_data
@@ -0,0 +1,249 @@
+import os
+import resource
+import shutil
+import tempfile
+from os.path import join
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from atomic_files import atomic_path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+MEMORY_BUDGET_ENV_VAR = "FLIGHT_EXTRACTOR_MEMORY_BUDGET_MB"
+# A json parsed to Python objects and structured takes about this many times its file size
+JSON_EXPANSION_FACTOR = 10
+# Share of the budget that the parent can hold in results before spilling them
+SPILL_SHARE = 0.25
+
+
+def memory_budget_from_env():
+    """Get the memory budget requested through the environment.
+
+    Return
+    ------
+    memory_budget_mb: int or None
+        Value of FLIGHT_EXTRACTOR_MEMORY_BUDGET_MB, None if it is not set.
+    """
+    value = os.environ.get(MEMORY_BUDGET_ENV_VAR)
+    return int(value) if value else None
+
+
+def process_rss_bytes():
+    """Resident memory of this process.
+
+    Return
+    ------
+    rss: int
+        Bytes, from /proc when available, otherwise the peak reported by getrusage.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_rss_bytes():
+    """Resident memory of the child processes (the workers).
+
+    Return
+    ------
+    rss: int or None
+        Bytes, None if psutil is not installed.
+    """
+    if psutil is None:
+        return None
+    total = 0
+    for child in psutil.Process().children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+class MemoryThrottle():
+    """Decides whether one more json can be sent to the workers within the budget."""
+    def __init__(self, memory_budget_mb, max_workers):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        memory_budget_mb: int
+            Memory that the whole extraction (parent and workers) should stay under.
+        max_workers: int
+            Maximum number of jsons in flight.
+        """
+        self.budget_bytes = memory_budget_mb * 1024 * 1024
+        self.max_workers = max_workers
+        self.in_flight = dict()
+
+    def estimate(self, json_path):
+        """Estimated peak memory of structuring one json."""
+        return os.path.getsize(json_path) * JSON_EXPANSION_FACTOR
+
+    def used_bytes(self):
+        """Observed memory of the parent plus observed or estimated memory of the workers."""
+        children_rss = children_rss_bytes()
+        if children_rss is None:
+            return process_rss_bytes() + sum(self.in_flight.values())
+        # Workers only report the memory they already use, so the estimates of the
+        # jsons in flight are added too (a conservative count)
+        return process_rss_bytes() + children_rss + sum(self.in_flight.values())
+
+    def can_submit(self, json_path):
+        """Checks if a json can be submitted now.
+
+        A json is always accepted when nothing is in flight, so a file larger than
+        the budget still completes (alone).
+        """
+        if len(self.in_flight) == 0:
+            return True
+        if len(self.in_flight) >= self.max_workers:
+            return False
+        return self.used_bytes() + self.estimate(json_path) <= self.budget_bytes
+
+    def submitted(self, json_path):
+        self.in_flight[json_path] = self.estimate(json_path)
+
+    def done(self, json_path):
+        self.in_flight.pop(json_path, None)
+
+
+def unify_schemas(schemas):
+    """Merge the schemas of the spilled batches.
+
+    Columns missing in a batch are allowed. A column that is null in some batches
+    takes the type of the others; integer and float columns become float64; other
+    conflicts become strings.
+
+    Parameters
+    ----------
+    schemas: list[pa.Schema]
+        Schemas of the batches.
+
+    Return
+    ------
+    schema: pa.Schema
+        Schema every batch can be cast to.
+    """
+    types = dict()
+    for schema in schemas:
+        for field in schema:
+            current = types.get(field.name)
+            if current is None or pa.types.is_null(current):
+                types[field.name] = field.type
+            elif pa.types.is_null(field.type) or current.equals(field.type):
+                continue
+            elif ((pa.types.is_integer(current) or pa.types.is_floating(current))
+                  and (pa.types.is_integer(field.type) or pa.types.is_floating(field.type))):
+                types[field.name] = pa.float64()
+            else:
+                types[field.name] = pa.string()
+    return pa.schema([pa.field(name, data_type) for name, data_type in types.items()])
+
+
+def align_table(table, schema):
+    """Cast a table to a schema, adding the missing columns as nulls.
+
+    Parameters
+    ----------
+    table: pa.Table
+        Table of one batch.
+    schema: pa.Schema
+        Output of unify_schemas.
+
+    Return
+    ------
+    table: pa.Table
+        Table with exactly the columns of schema.
+    """
+    columns = list()
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table[field.name].cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class SpillBuffer():
+    """Holds structured DataFrames and spills them to Arrow IPC files over a limit."""
+    def __init__(self, spill_bytes, spill_dir=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        spill_bytes: int
+            Memory of buffered DataFrames above which they are written to disk.
+        spill_dir: str (default=None)
+            Folder of the temporary IPC files. If None, a temporary folder.
+        """
+        self.spill_bytes = spill_bytes
+        self.spill_dir = tempfile.mkdtemp(prefix="flight_extractor_spill_", dir=spill_dir)
+        self.buffered = list()
+        self.buffered_bytes = 0
+        self.spill_paths = list()
+
+    def add(self, structured_data):
+        """Buffer one structured DataFrame, spilling the buffer if it is over the limit."""
+        if structured_data.empty:
+            return
+        self.buffered.append(structured_data)
+        self.buffered_bytes += int(structured_data.memory_usage(deep=True).sum())
+        if self.buffered_bytes > self.spill_bytes:
+            self.spill()
+
+    def spill(self):
+        """Write the buffered DataFrames to one IPC file."""
+        if len(self.buffered) == 0:
+            return
+        batch = pd.concat(self.buffered, ignore_index=True)
+        table = pa.Table.from_pandas(batch, preserve_index=False)
+        spill_path = join(self.spill_dir, f"batch_{len(self.spill_paths):05d}.arrow")
+        with pa.OSFile(spill_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.spill_paths.append(spill_path)
+        self.buffered = list()
+        self.buffered_bytes = 0
+
+    def write_parquet(self, output_path):
+        """Stream every spilled batch into one parquet, one batch in memory at a time.
+
+        Parameters
+        ----------
+        output_path: str
+            Output parquet, written atomically (see atomic_files.atomic_path).
+
+        Return
+        ------
+        n_rows: int
+            Rows written.
+        """
+        self.spill()
+        n_rows = 0
+        with atomic_path(output_path) as temporary_path:
+            if len(self.spill_paths) == 0:
+                pd.DataFrame().to_parquet(temporary_path)
+            else:
+                schemas = [pa.ipc.open_file(pa.memory_map(path)).schema for path in self.spill_paths]
+                schema = unify_schemas(schemas)
+                with pq.ParquetWriter(temporary_path, schema) as writer:
+                    for path in self.spill_paths:
+                        # Memory mapped, so only the pages being written are resident
+                        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+                        writer.write_table(align_table(table, schema))
+                        n_rows += table.num_rows
+        return n_rows
+
+    def cleanup(self):
+        """Delete the spilled files."""
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,339 @@
+import pandas as pd
+
+
+SEPARATOR = "||"
+
+SOURCES = ("context", "leg", "offer", "segment", "segment_attribute")
+AGGREGATES = ("first", "join", "join_present", "join_list")
+
+
+class ColumnSpec():
+    """Description of one output column."""
+    def __init__(self, name, source, path=None, aggregate="first", dtype=None, default=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        name: str
+            Name of the output column.
+        source: str
+            Where the value is:
+            - "context": information about the search (path, search time...).
+            - "leg": data['legs'][i].
+            - "offer": data['offers'][i].
+            - "segment": each element of leg['segments'].
+            - "segment_attribute": each element of offer['segmentAttributes'][0].
+        path: tuple[str] (default=None, (name,))
+            Keys from the source to the value, e.g. ("freeCancellationBy", "raw").
+        aggregate: str (default="first")
+            - "first": the value itself (context, leg and offer sources).
+            - "join": the values of all segments as str joined by "||"; missing
+              values become str(default).
+            - "join_present": as "join" but missing values are skipped, None if no
+              segment has the value.
+            - "join_list": the value is a list that is joined by "||", None if empty.
+        dtype: str (default=None)
+            pandas dtype of the column. If None, it is inferred.
+        default: (default=None)
+            Value used when the path does not exist.
+        """
+        if path is None:
+            path = (name,)
+        assert source in SOURCES, f"source must be one of {SOURCES}, but source={source}"
+        assert aggregate in AGGREGATES, (f"aggregate must be one of {AGGREGATES}, "
+                                         f"but aggregate={aggregate}")
+        is_segment_source = source in ("segment", "segment_attribute")
+        assert is_segment_source == (aggregate in ("join", "join_present")), (
+            f"column {name}: segment sources need a join aggregate and other sources do not")
+        self.name = name
+        self.source = source
+        self.path = tuple(path)
+        self.aggregate = aggregate
+        self.dtype = dtype
+        self.default = default
+
+
+class Schema():
+    """Ordered columns of one output format."""
+    def __init__(self, name, columns, passthrough=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        name: str
+            Name of the schema.
+        columns: list[ColumnSpec]
+            Columns in output order.
+        passthrough: dict[str, set[str]] (default=None)
+            Sources ("leg", "offer", "segment", "segment_attribute") whose keys
+            without a column are also copied to the output, mapped to the keys
+            that must not be copied. Segment keys are joined as "join_present".
+            The copied columns are placed after the declared ones.
+        """
+        self.name = name
+        self.columns = list(columns)
+        self.passthrough = dict(passthrough or {})
+        names = [column.name for column in self.columns]
+        assert len(names) == len(set(names)), f"schema {name} has repeated column names"
+
+    def claimed_keys(self, source):
+        """Get the keys of a source that must not be passed through.
+
+        Parameters
+        ----------
+        source: str
+            Source of the keys.
+
+        Return
+        ------
+        claimed_keys: frozenset[str]
+            First key of the path of the declared columns plus the ignored keys.
+        """
+        declared = {column.path[0] for column in self.columns if column.source == source}
+        return frozenset(declared | set(self.passthrough.get(source, ())))
+
+    def dtypes(self):
+        """Get the declared dtypes.
+
+        Return
+        ------
+        dtypes: dict[str, str]
+            Column name -> dtype, only for the columns with dtype.
+        """
+        return {column.name: column.dtype for column in self.columns if column.dtype is not None}
+
+
+_BASES = {"context": "context", "leg": "leg", "offer": "offer",
+          "segment": "item", "segment_attribute": "item"}
+_ITEMS = {"segment": "segments", "segment_attribute": "attributes"}
+
+
+def _path_expression(base, path, default_name):
+    """Python expression that reads path from base, using default_name when missing."""
+    expression = base
+    for key in path[:-1]:
+        expression = f"({expression}.get({key!r}) or _EMPTY)"
+    return f"{expression}.get({path[-1]!r}, {default_name})"
+
+
+def _column_expression(column, default_name):
+    """Python expression that computes the value of one column."""
+    base = _BASES[column.source]
+    value = _path_expression(base, column.path, default_name)
+    if column.aggregate == "first":
+        return value
+    if column.aggregate == "join_list":
+        return f"(_SEPARATOR.join({value} or ()) or None)"
+    items = _ITEMS[column.source]
+    if column.aggregate == "join":
+        return f"_SEPARATOR.join([str({value}) for item in {items}])"
+    # join_present: only the segments that have the value
+    if len(column.path) == 1:
+        return f"_join_present({items}, {column.path[0]!r})"
+    missing = "_MISSING"
+    value = _path_expression(base, column.path, missing)
+    return (f"(_SEPARATOR.join([str(value) for value in [{value} for item in {items}] "
+            f"if value is not {missing}]) or None)")
+
+
+def _join_present(items, key):
+    values = [str(item[key]) for item in items if key in item]
+    return SEPARATOR.join(values) if values else None
+
+
+def compile_schema(schema):
+    """Compile a schema into a function that structures one leg and its offer.
+
+    The source of the function is generated once with one statement per column,
+    so structuring an offer does not loop over the keys of the json.
+
+    Parameters
+    ----------
+    schema: Schema
+        Schema to compile.
+
+    Return
+    ------
+    extract_row: callable
+        extract_row(leg, offer, context) -> dict with one entry per column.
+    """
+    namespace = {"_EMPTY": {}, "_MISSING": object(), "_SEPARATOR": SEPARATOR,
+                 "_join_present": _join_present}
+    lines = ["def extract_row(leg, offer, context):",
+             "    segments = leg.get('segments') or ()",
+             "    attributes = (offer.get('segmentAttributes') or ((),))[0] or ()",
+             "    row = {}"]
+    for index, column in enumerate(schema.columns):
+        default_name = f"_default_{index}"
+        namespace[default_name] = column.default
+        lines.append(f"    row[{column.name!r}] = {_column_expression(column, default_name)}")
+
+    for source in ("leg", "offer"):
+        if source in schema.passthrough:
+            namespace[f"_claimed_{source}"] = schema.claimed_keys(source)
+            lines += [f"    for key in {source}.keys() - _claimed_{source}:",
+                      f"        row[key] = {source}[key]"]
+    for source in ("segment", "segment_attribute"):
+        if source in schema.passthrough:
+            items = _ITEMS[source]
+            namespace[f"_claimed_{source}"] = schema.claimed_keys(source)
+            lines += [f"    if {items}:",
+                      f"        for key in set().union(*{items}) - _claimed_{source}:",
+                      f"            row[key] = _join_present({items}, key)"]
+    lines.append("    return row")
+
+    source_code = "\n".join(lines)
+    exec(compile(source_code, f"<schema {schema.name}>", "exec"), namespace)
+    extract_row = namespace["extract_row"]
+    extract_row.source_code = source_code
+    return extract_row
+
+
+_compiled_schemas = dict()
+
+
+def get_extractor(schema):
+    """Get the compiled function of a schema, compiling it once per process.
+
+    Compiled functions can not be pickled, so the workers compile the schema
+    they receive the first time they use it.
+
+    Parameters
+    ----------
+    schema: Schema
+        Schema to compile.
+
+    Return
+    ------
+    extract_row: callable
+        See compile_schema.
+    """
+    if schema.name not in _compiled_schemas:
+        _compiled_schemas[schema.name] = compile_schema(schema)
+    return _compiled_schemas[schema.name]
+
+
+def rows_to_dataframe(rows, schema):
+    """Build the DataFrame of a list of rows extracted with a schema.
+
+    Parameters
+    ----------
+    rows: list[dict]
+        Output of the compiled function.
+    schema: Schema
+        Schema used to extract the rows.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        Declared columns in order, then the passed through columns sorted by name,
+        with the declared dtypes.
+    """
+    declared = [column.name for column in schema.columns]
+    structured_data = pd.DataFrame.from_records(rows)
+    extra = sorted(set(structured_data.columns) - set(declared))
+    structured_data = structured_data.reindex(columns=declared + extra)
+    return structured_data.astype(schema.dtypes())
+
+
+# Layout of the Kaggle dataset (flightextract.py)
+KAGGLE_SCHEMA = Schema("kaggle", [
+    ColumnSpec("legId", "leg", dtype="object"),
+    ColumnSpec("searchDate", "context", dtype="object"),
+    ColumnSpec("flightDate", "context", dtype="object"),
+    ColumnSpec("startingAirport", "context", dtype="object"),
+    ColumnSpec("destinationAirport", "context", dtype="object"),
+    ColumnSpec("fareBasisCode", "leg", dtype="object"),
+    ColumnSpec("travelDuration", "leg", dtype="object"),
+    ColumnSpec("elapsedDays", "leg", dtype="int64"),
+    ColumnSpec("isBasicEconomy", "leg", dtype="bool"),
+    ColumnSpec("isRefundable", "leg", dtype="bool"),
+    ColumnSpec("isNonStop", "leg", dtype="bool"),
+    ColumnSpec("baseFare", "offer", dtype="float64"),
+    ColumnSpec("totalFare", "offer", dtype="float64"),
+    ColumnSpec("seatsRemaining", "offer", dtype="int64"),
+    ColumnSpec("totalTravelDistance", "leg", dtype="float64"),
+    ColumnSpec("segmentsDepartureTimeEpochSeconds", "segment", ("departureTimeEpochSeconds",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsDepartureTimeRaw", "segment", ("departureTimeRaw",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsArrivalTimeEpochSeconds", "segment", ("arrivalTimeEpochSeconds",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsArrivalTimeRaw", "segment", ("arrivalTimeRaw",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsArrivalAirportCode", "segment", ("arrivalAirportCode",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsDepartureAirportCode", "segment", ("departureAirportCode",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsAirlineName", "segment", ("airlineName",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsAirlineCode", "segment", ("airlineCode",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsEquipmentDescription", "segment", ("equipmentDescription",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsDurationInSeconds", "segment", ("durationInSeconds",),
+               aggregate="join", dtype="object"),
+    ColumnSpec("segmentsDistance", "segment", ("distance",), aggregate="join", dtype="object"),
+    ColumnSpec("segmentsCabinCode", "segment_attribute", ("cabinCode",),
+               aggregate="join", dtype="object"),
+])
+
+# Layout of the daily structured parquet (flight_extractor.py). Keys of the json
+# that have no column are passed through, except the ones listed here.
+WIDE_SCHEMA = Schema("wide", [
+    ColumnSpec("search_time", "context"),
+    ColumnSpec("operational_search_time", "context"),
+    ColumnSpec("flight_day", "context"),
+    ColumnSpec("origin_code", "context"),
+    ColumnSpec("origin_city", "context"),
+    ColumnSpec("destination_code", "context"),
+    ColumnSpec("destination_city", "context"),
+
+    ColumnSpec("legId", "leg"),
+    ColumnSpec("fareBasisCode", "leg"),
+    ColumnSpec("travelDuration", "leg"),
+    ColumnSpec("elapsedDays", "leg"),
+    ColumnSpec("isBasicEconomy", "leg"),
+    ColumnSpec("isRefundable", "leg"),
+    ColumnSpec("isNonStop", "leg"),
+    ColumnSpec("totalTravelDistance", "leg"),
+    ColumnSpec("freeCancellationBy", "leg", ("freeCancellationBy", "raw")),
+
+    ColumnSpec("departureTimeRaw", "segment", aggregate="join_present"),
+    ColumnSpec("arrivalTimeRaw", "segment", aggregate="join_present"),
+    ColumnSpec("departureAirportCode", "segment", aggregate="join_present"),
+    ColumnSpec("arrivalAirportCode", "segment", aggregate="join_present"),
+    ColumnSpec("airlineName", "segment", aggregate="join_present"),
+    ColumnSpec("airlineCode", "segment", aggregate="join_present"),
+    ColumnSpec("equipmentDescription", "segment", aggregate="join_present"),
+    ColumnSpec("durationInSeconds", "segment", aggregate="join_present"),
+    ColumnSpec("distance", "segment", aggregate="join_present"),
+
+    ColumnSpec("baseFare", "offer"),
+    ColumnSpec("totalFare", "offer"),
+    ColumnSpec("seatsRemaining", "offer"),
+    ColumnSpec("currency", "offer"),
+    ColumnSpec("averageTotalPricePerTicket", "offer", ("averageTotalPricePerTicket", "amount")),
+    ColumnSpec("flightFulfillmentMethod", "offer", aggregate="join_list"),
+    ColumnSpec("loyaltyInfo_isBurnApplied", "offer", ("loyaltyInfo", "isBurnApplied")),
+    ColumnSpec("loyaltyInfo_points_base", "offer", ("loyaltyInfo", "earn", "points", "base")),
+    ColumnSpec("loyaltyInfo_points_bonus", "offer", ("loyaltyInfo", "earn", "points", "bonus")),
+    ColumnSpec("loyaltyInfo_points_total", "offer", ("loyaltyInfo", "earn", "points", "total")),
+
+    # Files structured before this spec hold only the last segment's value,
+    # e.g. "coach" where it is now "coach||coach"
+    ColumnSpec("cabinCode", "segment_attribute", aggregate="join_present"),
+    # The passed through segment keys (e.g. distance) skip the segments without the
+    # key; before this spec a key missing from the last segment left a trailing
+    # separator, e.g. "500||" where it is now "500"
+], passthrough={
+    "leg": {"baggageFeesUrl", "segments"},
+    "segment": {"departureTime", "departureTimeEpochSeconds", "arrivalTime",
+                "arrivalTimeEpochSeconds", "arrivalAirportLocation", "arrivalAirportName",
+                "arrivalAirportAddress", "departureAirportLocation", "departureAirportName",
+                "departureAirportAddress", "airlineImageFileName"},
+    "offer": {"legIds", "baseFarePrice", "totalFarePrice", "totalPrice", "taxesPrice",
+              "feesPrice", "productKey", "mobileShoppingKey", "baggageFeesUrl",
+              "fareBasisCodes", "pricePerPassengerCategory", "segmentAttributes"},
+    "segment_attribute": set(),
+})
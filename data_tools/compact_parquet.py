@@ -0,0 +1,272 @@
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from glob import glob
+from os.path import basename, getmtime, isfile, join
+from time import time, time_ns
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from atomic_files import atomic_path, write_json_atomic
+from bounded_extraction import align_table, unify_schemas
+
+
+SORT_KEYS = ["origin_code", "destination_code", "flight_day", "search_time", "legId"]
+# Low cardinality columns that benefit from dictionary encoding
+DICTIONARY_COLUMNS = ["origin_code", "origin_city", "destination_code", "destination_city",
+                      "flight_day", "operational_search_time", "fareBasisCode", "airlineName",
+                      "airlineCode", "equipmentDescription", "cabinCode", "currency",
+                      "departureAirportCode", "arrivalAirportCode", "travelDuration"]
+ROW_GROUP_SIZE = 256 * 1024
+COMPRESSION = "zstd"
+
+MANIFEST_NAME = "structured_manifest.json"
+DAILY_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})_structured_data(\.part-[^.]+)?\.parquet$")
+
+
+def _read_manifest(structured_dir):
+    manifest_path = join(structured_dir, MANIFEST_NAME)
+    if not isfile(manifest_path):
+        return {"compacted": {}, "superseded": []}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def _write_manifest(structured_dir, manifest):
+    write_json_atomic(join(structured_dir, MANIFEST_NAME), manifest, indent=1)
+
+
+def list_daily_files(structured_dir):
+    """List the daily files and the incremental parts of the structured output.
+
+    Parameters
+    ----------
+    structured_dir: str
+        Folder with the <day>_structured_data[.part-<shard>].parquet files.
+
+    Return
+    ------
+    daily_files: dict[str, list[str]]
+        Day (YYYY-MM-DD) -> file names of the day.
+    """
+    daily_files = dict()
+    for path in sorted(glob(join(structured_dir, "*_structured_data*.parquet"))):
+        match = DAILY_PATTERN.match(basename(path))
+        if match is not None:
+            daily_files.setdefault(match.group(1), list()).append(basename(path))
+    return daily_files
+
+
+def list_structured_files(structured_dir):
+    """List the files a reader should scan, without the data already compacted.
+
+    Parameters
+    ----------
+    structured_dir: str
+        Folder of the structured output.
+
+    Return
+    ------
+    structured_files: dict[str, list[str]]
+        Day (YYYY-MM-DD) -> paths of the files that hold it. Days of a compacted
+        period point to the compacted file.
+    """
+    manifest = _read_manifest(structured_dir)
+    structured_files = dict()
+    for entry in manifest["compacted"].values():
+        for day in entry["days"]:
+            structured_files[day] = [join(structured_dir, entry["file"])]
+    # Daily files written after the compaction (e.g. a reprocessed day) are newer
+    for day, file_names in _pending_daily_files(structured_dir, manifest).items():
+        structured_files[day] = [join(structured_dir, file_name) for file_name in file_names]
+    return structured_files
+
+
+def _pending_daily_files(structured_dir, manifest):
+    """Daily files that were not compacted yet."""
+    # A day rewritten after its compaction keeps the name but not the mtime
+    superseded = {(entry["file"], entry["mtime"]) for entry in manifest["superseded"]}
+    pending_files = dict()
+    for day, file_names in list_daily_files(structured_dir).items():
+        file_names = [file_name for file_name in file_names
+                      if (file_name, getmtime(join(structured_dir, file_name))) not in superseded]
+        if len(file_names) > 0:
+            pending_files[day] = file_names
+    return pending_files
+
+
+def read_structured_day(structured_dir, day, columns=None):
+    """Read the structured data of one search day, compacted or not.
+
+    Parameters
+    ----------
+    structured_dir: str
+        Folder of the structured output.
+    day: str
+        Day (YYYY-MM-DD).
+    columns: list[str] (default=None)
+        Columns to read. If None, all.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        Rows of the day, empty if the day does not exist.
+    """
+    paths = list_structured_files(structured_dir).get(day, [])
+    if len(paths) == 0:
+        return pa.table({}).to_pandas()
+    dataset = ds.dataset(paths, format="parquet")
+    return dataset.to_table(columns=columns, filter=_day_filter(day)).to_pandas()
+
+
+def _day_filter(day):
+    """Rows of one search day, by operational_search_time."""
+    next_day = str(datetime.strptime(day, "%Y-%m-%d").date() + timedelta(days=1))
+    return ((ds.field("operational_search_time") >= day)
+            & (ds.field("operational_search_time") < next_day))
+
+
+def write_sorted_parquet(tables, schema, path, row_group_size=ROW_GROUP_SIZE,
+                         compression=COMPRESSION):
+    """Sort tables one at a time and write them with tuned row groups, encodings and statistics.
+
+    Only one table is in memory at a time, so a month is written with the memory of
+    its largest day. The rows are sorted by SORT_KEYS within each table, not across
+    them: a file written from one table per search day is ordered by search day
+    first, so each day's run of row groups spans every route and the statistics on
+    origin_code only skip row groups within a day.
+
+    Parameters
+    ----------
+    tables: iterable[pa.Table]
+        Structured data, e.g. one table per search day.
+    schema: pa.Schema
+        Schema of the output, see bounded_extraction.unify_schemas.
+    path: str
+        Output path, written atomically.
+    row_group_size: int (default=ROW_GROUP_SIZE)
+        Maximum rows per row group.
+    compression: str (default=COMPRESSION)
+        Parquet compression codec.
+    """
+    sort_keys = [(key, "ascending") for key in SORT_KEYS if key in schema.names]
+    use_dictionary = [column for column in DICTIONARY_COLUMNS if column in schema.names]
+    with atomic_path(path) as temporary_path:
+        with pq.ParquetWriter(temporary_path, schema, compression=compression,
+                              use_dictionary=use_dictionary, write_statistics=True) as writer:
+            for table in tables:
+                if table.num_rows > 0:
+                    writer.write_table(align_table(table, schema).sort_by(sort_keys),
+                                       row_group_size=row_group_size)
+
+
+def _new_compacted_name(structured_dir, period_key):
+    """A file name no other version of the period uses."""
+    while True:
+        compacted_name = f"{period_key}_compacted.v{time_ns()}.parquet"
+        if not isfile(join(structured_dir, compacted_name)):
+            return compacted_name
+
+
+def compact_structured_data(structured_dir, period="month", row_group_size=ROW_GROUP_SIZE,
+                            grace_seconds=24 * 60 * 60, exclude_days=()):
+    """Merge the daily files into one sorted file per period.
+
+    The period is written search day by search day (rows sorted by SORT_KEYS within
+    each day, not across the period), so only one day is in memory at a time. The
+    swap is atomic for readers that use list_structured_files: the compacted file
+    is written and renamed, then the manifest is replaced so the days point to it.
+    The replaced files are only deleted by a later run after grace_seconds, so a
+    reader that listed them before the swap can still open them.
+
+    Parameters
+    ----------
+    structured_dir: str
+        Folder of the structured output.
+    period: str (default="month")
+        "month" or "day", the span of each compacted file.
+    row_group_size: int (default=ROW_GROUP_SIZE)
+        Maximum rows per row group.
+    grace_seconds: int (default=one day)
+        Minimum age of replaced files before they are deleted.
+    exclude_days: list[str] (default=())
+        Days that must not be compacted yet (e.g. the day being extracted).
+
+    Return
+    ------
+    compacted_periods: list[str]
+        Periods that were (re)written.
+    """
+    assert period in ("month", "day"), f"period must be 'month' or 'day', but period={period}"
+    manifest = _read_manifest(structured_dir)
+    _delete_superseded(structured_dir, manifest, grace_seconds)
+
+    days_by_period = dict()
+    for day, file_names in _pending_daily_files(structured_dir, manifest).items():
+        if day in exclude_days:
+            continue
+        period_key = day[:7] if period == "month" else day
+        days_by_period.setdefault(period_key, dict())[day] = file_names
+
+    compacted_periods = list()
+    for period_key, daily_files in sorted(days_by_period.items()):
+        previous = manifest["compacted"].get(period_key)
+        source_files = [file_name for file_names in daily_files.values() for file_name in file_names]
+        previous_days = previous["days"] if previous is not None else []
+        if previous is not None:
+            source_files.append(previous["file"])
+        schema = unify_schemas([pq.read_schema(join(structured_dir, file_name))
+                                for file_name in source_files])
+        days = sorted(set(daily_files) | set(previous_days))
+
+        def day_tables():
+            for day in days:
+                if day in daily_files:
+                    # Reprocessed days replace their rows in the previous version
+                    yield from (pq.read_table(join(structured_dir, file_name))
+                                for file_name in daily_files[day])
+                else:
+                    previous_dataset = ds.dataset(join(structured_dir, previous["file"]),
+                                                  format="parquet")
+                    yield previous_dataset.to_table(filter=_day_filter(day))
+
+        # A new name per version, so a reader of the previous version is not affected
+        compacted_name = _new_compacted_name(structured_dir, period_key)
+        write_sorted_parquet(day_tables(), schema, join(structured_dir, compacted_name),
+                             row_group_size=row_group_size)
+
+        manifest["compacted"][period_key] = {"file": compacted_name, "days": days}
+        live_files = {entry["file"] for entry in manifest["compacted"].values()}
+        manifest["superseded"] += [{"file": file_name, "time": time(),
+                                    "mtime": getmtime(join(structured_dir, file_name))}
+                                   for file_name in source_files if file_name not in live_files]
+        _write_manifest(structured_dir, manifest)
+        compacted_periods.append(period_key)
+    return compacted_periods
+
+
+def _delete_superseded(structured_dir, manifest, grace_seconds):
+    """Delete the files replaced by a compaction more than grace_seconds ago."""
+    live_files = {entry["file"] for entry in manifest["compacted"].values()}
+    kept = list()
+    for entry in manifest["superseded"]:
+        path = join(structured_dir, entry["file"])
+        if entry["file"] in live_files:
+            # Never delete a file the manifest points to
+            continue
+        if time() - entry["time"] < grace_seconds:
+            kept.append(entry)
+        elif isfile(path) and getmtime(path) == entry["mtime"]:
+            os.remove(path)
+    manifest["superseded"] = kept
+    _write_manifest(structured_dir, manifest)
+
+
+if __name__ == "__main__":
+    structured_dir = "/home/mborges/structured_data"
+    today = datetime.now().date()
+    # The latest days may still be being extracted
+    recent_days = [str(today - timedelta(days=day)) for day in range(0, 2)]
+    print(compact_structured_data(structured_dir, period="month", exclude_days=recent_days))
@@ -0,0 +1,140 @@
+import pandas as pd
+
+
+SEPARATOR = "||"
+
+# Columns of each schema (see column_spec.py) that the derived columns are computed from
+SOURCE_COLUMNS = {
+    "wide": {"travel_duration": "travelDuration",
+             "departure_time_raw": "departureTimeRaw",
+             "arrival_time_raw": "arrivalTimeRaw",
+             "duration_in_seconds": "durationInSeconds"},
+    "kaggle": {"travel_duration": "travelDuration",
+               "departure_time_raw": "segmentsDepartureTimeRaw",
+               "arrival_time_raw": "segmentsArrivalTimeRaw",
+               "duration_in_seconds": "segmentsDurationInSeconds"},
+}
+
+# ISO 8601 durations as written by Expedia, e.g. PT2H35M or P1DT3H
+DURATION_PATTERN = r"^P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?)?$"
+
+
+def parse_iso_durations(durations):
+    """Convert ISO 8601 durations to minutes.
+
+    Parameters
+    ----------
+    durations: pd.Series
+        Strings like "PT2H35M".
+
+    Return
+    ------
+    minutes: pd.Series
+        Total minutes as float, NaN when the value is missing or not a duration.
+    """
+    parts = durations.astype("string").str.extract(DURATION_PATTERN).astype("float64")
+    minutes = (parts["days"].fillna(0) * 24 * 60
+               + parts["hours"].fillna(0) * 60
+               + parts["minutes"].fillna(0))
+    # A string that did not match gives NaN in all the groups
+    return minutes.where(parts.notna().any(axis="columns"))
+
+
+def first_segment(values):
+    """Get the first element of "||" separated strings.
+
+    Parameters
+    ----------
+    values: pd.Series
+        Strings with one value per segment.
+
+    Return
+    ------
+    first: pd.Series
+        Value of the first segment.
+    """
+    # regex=False: pandas reads a multi-character pattern as a regex, and "||" matches
+    # the empty string
+    return values.astype("string").str.split(SEPARATOR, n=1, regex=False).str[0]
+
+
+def last_segment(values):
+    """Get the last element of "||" separated strings.
+
+    Parameters
+    ----------
+    values: pd.Series
+        Strings with one value per segment.
+
+    Return
+    ------
+    last: pd.Series
+        Value of the last segment.
+    """
+    return values.astype("string").str.rsplit(SEPARATOR, n=1).str[-1]
+
+
+def sum_segments(values):
+    """Sum the numeric elements of "||" separated strings.
+
+    Parameters
+    ----------
+    values: pd.Series
+        Strings with one number per segment. Values that are not numbers
+        (e.g. "None") are ignored.
+
+    Return
+    ------
+    total: pd.Series
+        Sum of the segments, NaN if no segment is a number.
+    """
+    split_values = values.astype("string").str.split(SEPARATOR, expand=True, regex=False)
+    numeric_values = split_values.apply(pd.to_numeric, errors="coerce")
+    return numeric_values.sum(axis="columns", min_count=1)
+
+
+def add_derived_columns(structured_data, schema_name="wide"):
+    """Add numeric columns parsed from the string columns, whole columns at a time.
+
+    Added columns:
+    - travelDurationMinutes: travelDuration in minutes.
+    - segmentsCount: number of segments of the leg.
+    - firstDepartureUtc: departure of the first segment (UTC timestamp).
+    - lastArrivalUtc: arrival of the last segment (UTC timestamp).
+    - flightMinutes: sum of the segments' durations in minutes.
+    - layoverMinutes: time between first departure and last arrival not spent flying.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Output of FlightExtractor or flightextract.py.
+    schema_name: str (default="wide")
+        Schema of structured_data, a key of SOURCE_COLUMNS.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        The same DataFrame with the added columns.
+    """
+    columns = SOURCE_COLUMNS[schema_name]
+    departure_time_raw = structured_data[columns["departure_time_raw"]]
+    arrival_time_raw = structured_data[columns["arrival_time_raw"]]
+
+    structured_data["travelDurationMinutes"] = parse_iso_durations(
+        structured_data[columns["travel_duration"]]
+    )
+    structured_data["segmentsCount"] = (
+        departure_time_raw.astype("string").str.count(r"\|\|") + 1
+    ).astype("Int64")
+    structured_data["firstDepartureUtc"] = pd.to_datetime(
+        first_segment(departure_time_raw), utc=True, errors="coerce"
+    )
+    structured_data["lastArrivalUtc"] = pd.to_datetime(
+        last_segment(arrival_time_raw), utc=True, errors="coerce"
+    )
+    structured_data["flightMinutes"] = sum_segments(structured_data[columns["duration_in_seconds"]]) / 60
+    elapsed_minutes = (
+        (structured_data["lastArrivalUtc"] - structured_data["firstDepartureUtc"]).dt.total_seconds() / 60
+    )
+    structured_data["layoverMinutes"] = elapsed_minutes - structured_data["flightMinutes"]
+    return structured_data
@@ -0,0 +1,275 @@
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+from io import StringIO
+from time import perf_counter
+
+import pandas as pd
+from atomic_files import atomic_path, write_bytes_atomic
+
+
+PROFILE_ENV_VAR = "FLIGHT_EXTRACTOR_PROFILE"
+CPROFILE_ENV_VAR = "FLIGHT_EXTRACTOR_CPROFILE"
+
+
+def profiling_enabled_from_env():
+    """Checks whether profiling was requested through the environment.
+
+    Return
+    ------
+    enabled: bool
+        True if FLIGHT_EXTRACTOR_PROFILE is set to a truthy value.
+    """
+    return os.environ.get(PROFILE_ENV_VAR, "").lower() in ("1", "true", "yes", "on")
+
+
+def cprofile_path_from_env():
+    """Get the path where the cProfile capture of one worker should be saved.
+
+    Return
+    ------
+    cprofile_path: str or None
+        Value of FLIGHT_EXTRACTOR_CPROFILE, None if it is not set.
+    """
+    return os.environ.get(CPROFILE_ENV_VAR) or None
+
+
+class StageTimer():
+    """Accumulates the time spent in each stage of the structuring of one json.
+
+    A disabled timer keeps the same interface but does not measure anything, so
+    the extraction code can always call it.
+    """
+    def __init__(self, enabled=True):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        enabled: bool (default=True)
+            If False, stage() and count() do nothing.
+        """
+        self.enabled = enabled
+        self.stages = dict()
+        self.counters = dict()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the wall time of the code inside the with block.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage, e.g. "read" or "data_checks".
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + perf_counter() - start
+
+    def count(self, name, value=1):
+        """Increment a counter.
+
+        Parameters
+        ----------
+        name: str
+            Name of the counter, e.g. "offers".
+        value: int (default=1)
+            Amount to add to the counter.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_record(self, json_path):
+        """Get the measurements of the timer.
+
+        Parameters
+        ----------
+        json_path: str
+            Json path the measurements refer to.
+
+        Return
+        ------
+        record: dict
+            Dictionary with json_path, the stages and the counters.
+        """
+        return {"json_path": json_path,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters)}
+
+
+class ExtractionProfiler():
+    """Aggregates the per-stage measurements of all workers of one extraction run."""
+    def __init__(self, cprofile_path=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        cprofile_path: str (default=None)
+            If given, the first json of the run is structured under cProfile and
+            the statistics are saved in this path.
+        """
+        self.cprofile_path = cprofile_path
+        self.file_records = list()
+        self.run_stages = dict()
+
+    def add_file_record(self, record):
+        """Add the measurements of one json.
+
+        Parameters
+        ----------
+        record: dict
+            Output of StageTimer.to_record.
+        """
+        self.file_records.append(record)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a stage that runs once per run in the parent process (e.g. concat).
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.run_stages[name] = self.run_stages.get(name, 0.0) + perf_counter() - start
+
+    def files_dataframe(self):
+        """Get one row per json with the time of each stage and the counters.
+
+        Return
+        ------
+        files_df: pd.DataFrame
+            Columns json_path, total_seconds, <stage>_seconds and the counters.
+        """
+        rows = list()
+        for record in self.file_records:
+            row = {"json_path": record["json_path"],
+                   "total_seconds": sum(record["stages"].values())}
+            row.update({f"{stage}_seconds": seconds
+                        for stage, seconds in record["stages"].items()})
+            row.update(record["counters"])
+            rows.append(row)
+        files_df = pd.DataFrame(rows)
+        if not files_df.empty:
+            files_df = files_df.sort_values("total_seconds", ascending=False, ignore_index=True)
+        return files_df
+
+    def stages_dataframe(self):
+        """Get the total time of each stage, summed across workers.
+
+        Worker stages are summed over all the jsons, so they are CPU-seconds of the
+        pool rather than wall time. Parent stages are measured once.
+
+        Return
+        ------
+        stages_df: pd.DataFrame
+            Columns stage, where ("worker" or "parent"), seconds and share.
+        """
+        worker_stages = dict()
+        for record in self.file_records:
+            for stage, seconds in record["stages"].items():
+                worker_stages[stage] = worker_stages.get(stage, 0.0) + seconds
+        rows = ([{"stage": stage, "where": "worker", "seconds": seconds}
+                 for stage, seconds in worker_stages.items()]
+                + [{"stage": stage, "where": "parent", "seconds": seconds}
+                   for stage, seconds in self.run_stages.items()])
+        stages_df = pd.DataFrame(rows, columns=["stage", "where", "seconds"])
+        total = stages_df["seconds"].sum()
+        stages_df["share"] = stages_df["seconds"] / total if total > 0 else 0.0
+        return stages_df.sort_values("seconds", ascending=False, ignore_index=True)
+
+    def counters_total(self):
+        """Get the counters summed across all jsons.
+
+        Return
+        ------
+        counters: dict
+            Counter name -> total.
+        """
+        counters = dict()
+        for record in self.file_records:
+            for name, value in record["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+        return counters
+
+    def report(self, top_n=10):
+        """Build a text report with the stage breakdown and the slowest jsons.
+
+        Parameters
+        ----------
+        top_n: int (default=10)
+            Number of slowest jsons to list.
+
+        Return
+        ------
+        report: str
+            The report.
+        """
+        buffer = StringIO()
+        buffer.write(f"Profiled {len(self.file_records)} json files\n")
+        for name, value in sorted(self.counters_total().items()):
+            buffer.write(f"  {name}: {value}\n")
+
+        buffer.write("\nStage breakdown\n")
+        for row in self.stages_dataframe().itertuples():
+            buffer.write(f"  {row.where:<6} {row.stage:<20} {row.seconds:10.3f}s {row.share:6.1%}\n")
+
+        files_df = self.files_dataframe()
+        buffer.write(f"\nSlowest {min(top_n, len(files_df))} files\n")
+        stage_columns = [column for column in files_df.columns if column.endswith("_seconds")
+                         and column != "total_seconds"]
+        for _, row in files_df.head(top_n).iterrows():
+            stages = ", ".join(f"{column[:-len('_seconds')]}={row[column]:.3f}s"
+                               for column in stage_columns if pd.notna(row[column]))
+            buffer.write(f"  {row['total_seconds']:8.3f}s {row['json_path']} ({stages})\n")
+
+        if self.cprofile_path is not None and os.path.isfile(self.cprofile_path):
+            buffer.write(f"\ncProfile of one worker saved at {self.cprofile_path}\n")
+            stats_buffer = StringIO()
+            pstats.Stats(self.cprofile_path, stream=stats_buffer).sort_stats("cumulative").print_stats(15)
+            buffer.write(stats_buffer.getvalue())
+        return buffer.getvalue()
+
+    def save(self, path_prefix):
+        """Save the report and the per-file measurements.
+
+        Parameters
+        ----------
+        path_prefix: str
+            Files <path_prefix>_profile.txt and <path_prefix>_profile_files.parquet are written.
+        """
+        write_bytes_atomic(path_prefix + "_profile.txt", self.report().encode("utf-8"))
+        files_df = self.files_dataframe()
+        if not files_df.empty:
+            with atomic_path(path_prefix + "_profile_files.parquet") as temporary_path:
+                files_df.to_parquet(temporary_path)
+
+
+def run_with_cprofile(cprofile_path, function, *args, **kwargs):
+    """Call a function under cProfile and save the statistics.
+
+    Parameters
+    ----------
+    cprofile_path: str
+        Path where the statistics are saved (readable with pstats or snakeviz).
+    function: callable
+        Function to profile.
+
+    Return
+    ------
+    output:
+        The output of function.
+    """
+    profiler = cProfile.Profile()
+    output = profiler.runcall(function, *args, **kwargs)
+    profiler.dump_stats(cprofile_path)
+    return output
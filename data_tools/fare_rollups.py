@@ -0,0 +1,353 @@
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from glob import glob
+from os.path import basename, isfile, join
+
+import numpy as np
+import pandas as pd
+from atomic_files import atomic_path, write_json_atomic
+from compact_parquet import read_structured_day
+
+
+# Finest grain of the rollups. Every search of a day lands in the partition of that day,
+# so a new day only adds groups and never changes the groups of the previous days.
+ROLLUP_KEYS = ["origin_code", "destination_code", "flight_day", "search_date", "days_to_departure"]
+# Grain of the table merged incrementally across all days
+ROUTE_KEYS = ["origin_code", "destination_code", "days_to_departure"]
+
+# Columns of the structured data that the rollups read
+SOURCE_COLUMNS = ["origin_code", "destination_code", "flight_day", "operational_search_time",
+                  "totalFare", "airlineName"]
+
+QUANTILES = {"fare_p10": 0.10, "fare_p25": 0.25, "fare_median": 0.50,
+             "fare_p75": 0.75, "fare_p90": 0.90}
+
+# The quantile sketch stores counts of logarithmic buckets, so it can be merged by
+# adding counts and any quantile is known within RELATIVE_ACCURACY (DDSketch)
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+PARTITION_PATTERN = "fare_rollup_{day}.parquet"
+ROUTE_TABLE_NAME = "fare_rollup_routes.parquet"
+MANIFEST_NAME = "fare_rollup_manifest.json"
+# The route table shares the prefix of the partitions, so the days are matched by name
+DAY_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def _write_parquet_atomic(df, path):
+    """Write a parquet so readers never see a partially written file."""
+    with atomic_path(path) as temporary_path:
+        df.to_parquet(temporary_path, index=False)
+
+
+def _fare_buckets(fares):
+    """Bucket index of each fare in the quantile sketch."""
+    return np.ceil(np.log(fares.to_numpy(dtype="float64")) / np.log(GAMMA)).astype("int64")
+
+
+def sketch_quantiles(buckets, counts, quantiles):
+    """Estimate quantiles from the buckets of one or more merged sketches.
+
+    Parameters
+    ----------
+    buckets: list[array-like]
+        Bucket indexes of each sketch.
+    counts: list[array-like]
+        Counts of the buckets of each sketch.
+    quantiles: list[float]
+        Quantiles to estimate, between 0 and 1.
+
+    Return
+    ------
+    values: list[float]
+        Estimated quantiles, within RELATIVE_ACCURACY of the exact value.
+    merged_buckets: np.ndarray
+        Bucket indexes of the merged sketch.
+    merged_counts: np.ndarray
+        Counts of the merged sketch.
+    """
+    all_buckets = np.concatenate([np.asarray(bucket, dtype="int64") for bucket in buckets])
+    all_counts = np.concatenate([np.asarray(count, dtype="int64") for count in counts])
+    merged_buckets, inverse = np.unique(all_buckets, return_inverse=True)
+    merged_counts = np.bincount(inverse, weights=all_counts).astype("int64")
+    cumulative_counts = np.cumsum(merged_counts)
+    total = cumulative_counts[-1]
+    values = list()
+    for quantile in quantiles:
+        rank = quantile * (total - 1)
+        index = np.searchsorted(cumulative_counts, rank, side="right")
+        values.append(2 * GAMMA ** merged_buckets[index] / (GAMMA + 1))
+    return values, merged_buckets, merged_counts
+
+
+def compute_fare_rollup(structured_data):
+    """Aggregate the fares of structured data at the ROLLUP_KEYS grain.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Output of FlightExtractor (wide schema).
+
+    Return
+    ------
+    rollup_df: pd.DataFrame
+        One row per group with fare_count, fare_sum, fare_min, the exact quantiles
+        of QUANTILES, cheapest_airline and the quantile sketch (sketch_buckets,
+        sketch_counts). Empty if there is no fare, e.g. a day where every json failed.
+    """
+    rollup_columns = (ROLLUP_KEYS + ["fare_count", "fare_sum", "fare_min"] + list(QUANTILES)
+                      + ["cheapest_airline", "sketch_buckets", "sketch_counts"])
+    if structured_data.empty:
+        return pd.DataFrame(columns=rollup_columns)
+    data = pd.DataFrame({
+        "origin_code": structured_data["origin_code"],
+        "destination_code": structured_data["destination_code"],
+        "flight_day": structured_data["flight_day"],
+        "search_date": structured_data["operational_search_time"].str[:10],
+        "totalFare": pd.to_numeric(structured_data["totalFare"], errors="coerce"),
+        "airlineName": structured_data["airlineName"],
+    })
+    data = data[data["totalFare"] > 0].reset_index(drop=True)
+    if data.empty:
+        return pd.DataFrame(columns=rollup_columns)
+    data["days_to_departure"] = (
+        pd.to_datetime(data["flight_day"]) - pd.to_datetime(data["search_date"])
+    ).dt.days
+
+    grouped = data.groupby(ROLLUP_KEYS, sort=True)["totalFare"]
+    rollup_df = grouped.agg(fare_count="count", fare_sum="sum", fare_min="min")
+    quantiles_df = grouped.quantile(list(QUANTILES.values())).unstack()
+    quantiles_df.columns = list(QUANTILES.keys())
+    rollup_df = rollup_df.join(quantiles_df)
+    rollup_df["cheapest_airline"] = data.loc[grouped.idxmin(), "airlineName"].to_numpy()
+
+    data["bucket"] = _fare_buckets(data["totalFare"])
+    bucket_counts = data.groupby(ROLLUP_KEYS + ["bucket"]).size().rename("count").reset_index()
+    sketch_df = bucket_counts.groupby(ROLLUP_KEYS).agg(sketch_buckets=("bucket", list),
+                                                       sketch_counts=("count", list))
+    return rollup_df.join(sketch_df).reset_index()
+
+
+def merge_rollups(rollup_df, group_by):
+    """Merge rollup rows into a coarser grain.
+
+    Counts, sums and minimums are exact; the quantiles are estimated from the merged
+    sketches (within RELATIVE_ACCURACY).
+
+    Parameters
+    ----------
+    rollup_df: pd.DataFrame
+        Rows of compute_fare_rollup or of a previous merge.
+    group_by: list[str]
+        Keys of the coarser grain, a subset of ROLLUP_KEYS.
+
+    Return
+    ------
+    merged_df: pd.DataFrame
+        Same columns as rollup_df, one row per group of group_by.
+    """
+    rows = list()
+    # pandas warns when iterating over a groupby by a one-element list
+    grouper = group_by[0] if len(group_by) == 1 else group_by
+    for keys, group in rollup_df.groupby(grouper, sort=True):
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        values, merged_buckets, merged_counts = sketch_quantiles(
+            group["sketch_buckets"], group["sketch_counts"], list(QUANTILES.values())
+        )
+        row = dict(zip(group_by, keys))
+        row.update({"fare_count": group["fare_count"].sum(),
+                    "fare_sum": group["fare_sum"].sum(),
+                    "fare_min": group["fare_min"].min()})
+        row.update(dict(zip(QUANTILES.keys(), values)))
+        row["cheapest_airline"] = group.loc[group["fare_min"].idxmin(), "cheapest_airline"]
+        row["sketch_buckets"] = merged_buckets.tolist()
+        row["sketch_counts"] = merged_counts.tolist()
+        rows.append(row)
+    columns = group_by + [column for column in rollup_df.columns if column not in ROLLUP_KEYS]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def _read_manifest(rollup_dir):
+    manifest_path = join(rollup_dir, MANIFEST_NAME)
+    if not isfile(manifest_path):
+        return {"route_table_days": []}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def _write_manifest(rollup_dir, manifest):
+    write_json_atomic(join(rollup_dir, MANIFEST_NAME), manifest, indent=1)
+
+
+def list_rollup_days(rollup_dir):
+    """List the days that have a rollup partition.
+
+    Parameters
+    ----------
+    rollup_dir: str
+        Directory of the rollups.
+
+    Return
+    ------
+    days: list[str]
+        Days (YYYY-MM-DD) in ascending order.
+    """
+    prefix, suffix = PARTITION_PATTERN.split("{day}")
+    paths = glob(join(rollup_dir, PARTITION_PATTERN.format(day="*")))
+    days = [basename(path)[len(prefix):-len(suffix)] for path in paths]
+    return sorted(day for day in days if DAY_PATTERN.match(day))
+
+
+def update_fare_rollups(structured_data, rollup_dir, day_str):
+    """Update the rollups with the structured data of one day.
+
+    The partition of the day is (re)written and merged into the route table. The
+    history is not rescanned, except when a day already merged is reprocessed: then
+    the route table is rebuilt from the partitions, which are small.
+
+    Parameters
+    ----------
+    structured_data: pd.DataFrame
+        Structured data of the day (wide schema).
+    rollup_dir: str
+        Directory of the rollups.
+    day_str: str
+        Day (YYYY-MM-DD) of the structured data, as in <day>_structured_data.parquet.
+
+    Return
+    ------
+    updated: bool
+        False if the day has no fare, then the rollups are left as they are.
+    """
+    day_rollup_df = compute_fare_rollup(structured_data)
+    if day_rollup_df.empty:
+        print(f"No fares on {day_str}, the rollups were not updated")
+        return False
+    os.makedirs(rollup_dir, exist_ok=True)
+    _write_parquet_atomic(day_rollup_df, join(rollup_dir, PARTITION_PATTERN.format(day=day_str)))
+
+    manifest = _read_manifest(rollup_dir)
+    route_table_path = join(rollup_dir, ROUTE_TABLE_NAME)
+    # Older versions recorded the route table itself as a day; its counts are rebuilt
+    stale = any(not DAY_PATTERN.match(day) for day in manifest["route_table_days"])
+    if day_str in manifest["route_table_days"] or stale or not isfile(route_table_path):
+        days = list_rollup_days(rollup_dir)
+        rollup_df = read_rollup_partitions(rollup_dir, days)
+        route_df = merge_rollups(rollup_df, ROUTE_KEYS)
+        _check_route_table(route_df, rollup_df)
+    else:
+        days = manifest["route_table_days"] + [day_str]
+        route_df = merge_rollups(
+            pd.concat([pd.read_parquet(route_table_path),
+                       merge_rollups(day_rollup_df, ROUTE_KEYS)], ignore_index=True),
+            ROUTE_KEYS
+        )
+    _write_parquet_atomic(route_df, route_table_path)
+    manifest["route_table_days"] = sorted(set(days))
+    _write_manifest(rollup_dir, manifest)
+    return True
+
+
+def _check_route_table(route_df, rollup_df):
+    """Checks the exact columns of a rebuilt route table against a plain groupby."""
+    expected_df = rollup_df.groupby(ROUTE_KEYS).agg(fare_count=("fare_count", "sum"),
+                                                    fare_sum=("fare_sum", "sum"),
+                                                    fare_min=("fare_min", "min"))
+    actual_df = route_df.set_index(ROUTE_KEYS)[["fare_count", "fare_sum", "fare_min"]]
+    pd.testing.assert_frame_equal(actual_df.sort_index(), expected_df.sort_index(),
+                                  check_dtype=False)
+
+
+def read_rollup_partitions(rollup_dir, days):
+    """Read the rollup partitions of some days.
+
+    Parameters
+    ----------
+    rollup_dir: str
+        Directory of the rollups.
+    days: list[str]
+        Days (YYYY-MM-DD) to read.
+
+    Return
+    ------
+    rollup_df: pd.DataFrame
+        Concatenated partitions.
+    """
+    rollup_list = [pd.read_parquet(join(rollup_dir, PARTITION_PATTERN.format(day=day)))
+                   for day in days]
+    if len(rollup_list) == 0:
+        return pd.DataFrame(columns=ROLLUP_KEYS)
+    return pd.concat(rollup_list, ignore_index=True)
+
+
+def _date_range(start, end):
+    start = datetime.strptime(start, "%Y-%m-%d").date()
+    end = datetime.strptime(end, "%Y-%m-%d").date()
+    return [str(start + timedelta(days=day)) for day in range((end - start).days + 1)]
+
+
+def query_fares(rollup_dir, search_dates=None, origin=None, destination=None,
+                flight_days=None, group_by=None, structured_dir=None):
+    """Fare statistics, read from the rollups when they cover the request.
+
+    Parameters
+    ----------
+    rollup_dir: str
+        Directory of the rollups.
+    search_dates: tuple[str, str] (default=None)
+        First and last search date (YYYY-MM-DD). If None, every day with rollups.
+    origin: str (default=None)
+        Origin airport code. If None, all.
+    destination: str (default=None)
+        Destination airport code. If None, all.
+    flight_days: tuple[str, str] (default=None)
+        First and last flight day (YYYY-MM-DD). If None, all.
+    group_by: list[str] (default=None, ROLLUP_KEYS)
+        Grain of the output, a subset of ROLLUP_KEYS. At the ROLLUP_KEYS grain the
+        quantiles are exact, otherwise they come from the merged sketches.
+    structured_dir: str (default=None)
+        Directory of the structured output (daily or compacted files), used for the
+        search dates without rollups. If None, those dates raise an error.
+
+    Return
+    ------
+    fares_df: pd.DataFrame
+        One row per group with fare_count, fare_sum, fare_min, the quantiles
+        and cheapest_airline.
+    """
+    if group_by is None:
+        group_by = ROLLUP_KEYS
+    if search_dates is None and origin is None and destination is None and flight_days is None \
+            and group_by == ROUTE_KEYS and isfile(join(rollup_dir, ROUTE_TABLE_NAME)):
+        route_df = pd.read_parquet(join(rollup_dir, ROUTE_TABLE_NAME))
+        return route_df.drop(columns=["sketch_buckets", "sketch_counts"], errors="ignore")
+
+    available_days = list_rollup_days(rollup_dir)
+    days = available_days if search_dates is None else _date_range(*search_dates)
+    missing_days = [day for day in days if day not in available_days]
+    rollup_df = read_rollup_partitions(rollup_dir, [day for day in days if day in available_days])
+
+    if len(missing_days) > 0:
+        assert structured_dir is not None, (f"The rollups do not cover the search dates "
+                                            f"{missing_days} and structured_dir was not given")
+        computed_list = list()
+        for day in missing_days:
+            structured_data = read_structured_day(structured_dir, day)
+            if not structured_data.empty:
+                computed_list.append(compute_fare_rollup(structured_data))
+        rollup_df = pd.concat([rollup_df] + computed_list, ignore_index=True)
+
+    if origin is not None:
+        rollup_df = rollup_df[rollup_df["origin_code"] == origin]
+    if destination is not None:
+        rollup_df = rollup_df[rollup_df["destination_code"] == destination]
+    if flight_days is not None:
+        rollup_df = rollup_df[rollup_df["flight_day"].between(*flight_days)]
+    if search_dates is not None:
+        rollup_df = rollup_df[rollup_df["search_date"].between(*search_dates)]
+
+    if list(group_by) != ROLLUP_KEYS:
+        rollup_df = merge_rollups(rollup_df, list(group_by))
+    return rollup_df.drop(columns=["sketch_buckets", "sketch_counts"], errors="ignore").reset_index(drop=True)
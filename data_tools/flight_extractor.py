@@ -1,21 +1,60 @@
 import json
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, wait
 from glob import glob
 
 import pandas as pd
-from joblib import Parallel, delayed
+from atomic_files import atomic_path
+from blob_resolver import resolve_blob_reference
+from bounded_extraction import SPILL_SHARE, MemoryThrottle, SpillBuffer, memory_budget_from_env
+from joblib import Parallel, delayed, effective_n_jobs
+from joblib.externals.loky import get_reusable_executor
+from extraction_profiler import (ExtractionProfiler, StageTimer, cprofile_path_from_env,
+                                 profiling_enabled_from_env, run_with_cprofile)
+from column_spec import WIDE_SCHEMA, get_extractor, rows_to_dataframe
+from derived_columns import add_derived_columns
 from map_collected_data import extract_info_from_path
+from raw_reader import prefetch_ahead, prefetch_window, read_json
+
+
+# Structured offers of the deduplicated bodies already seen by this process
+STRUCTURED_BLOB_CACHE_SIZE = 256
+_structured_blob_cache = OrderedDict()
 
 
 class FlightExtractor():
     """Structure the data collected from flight_scrape.py."""
-    def __init__(self, json_paths):
+    def __init__(self, json_paths, profile=None, cprofile_path=None, schema=WIDE_SCHEMA,
+                 derived_columns=False):
         """
         Parameters
         ----------
         json_paths: list[str]
             List of json's path whose data should be structured.
+        profile: bool (default=None)
+            If True, time each stage of the structuring and keep the measurements
+            in self.profiler. If None, the environment variable
+            FLIGHT_EXTRACTOR_PROFILE decides.
+        cprofile_path: str (default=None)
+            If given (or set in FLIGHT_EXTRACTOR_CPROFILE), the first json is
+            structured under cProfile and the statistics are saved in this path.
+            Only used when profiling is enabled.
+        schema: column_spec.Schema (default=WIDE_SCHEMA)
+            Columns of the structured data, WIDE_SCHEMA or KAGGLE_SCHEMA. Its context
+            columns are filled by _structure_collect_information.
+        derived_columns: bool (default=False)
+            If True, add the numeric columns of derived_columns.add_derived_columns
+            (durations in minutes, UTC timestamps, layovers) after the concat.
         """
         self.json_paths = json_paths
+        self.schema = schema
+        self.derived_columns = derived_columns
+        if profile is None:
+            profile = profiling_enabled_from_env()
+        if cprofile_path is None:
+            cprofile_path = cprofile_path_from_env()
+        self.profiler = ExtractionProfiler(cprofile_path=cprofile_path) if profile else None
         
     def structure_all_jsons(self, n_jobs=-1):
         """Structure all json's with parallel processing.
@@ -32,27 +71,178 @@ class FlightExtractor():
         error_log_df: pd.DataFrame
             The log of problems during data structuring.
         """
-        output_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
-            [delayed(self._structure_json)(json_path) for json_path in self.json_paths]
-        )
-        
+        # Generators, so joblib dispatches them lazily and the read ahead stays a few
+        # files in front of the workers
+        if self.profiler is None:
+            output_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+                delayed(self._structure_json)(json_path)
+                for json_path in prefetch_ahead(self.json_paths)
+            )
+        else:
+            use_cprofile = self.profiler.cprofile_path is not None
+            output_list = Parallel(n_jobs=n_jobs, prefer="processes", verbose=1)(
+                delayed(self._structure_json_profiled)(json_path, use_cprofile and index == 0)
+                for index, json_path in enumerate(prefetch_ahead(self.json_paths))
+            )
+            for _, _, record in output_list:
+                self.profiler.add_file_record(record)
+            output_list = [output[:2] for output in output_list]
+
         structured_data_list = list()
         error_log_list = list()
         for structured_data, error_log_df in output_list:
             structured_data_list.append(structured_data)
             error_log_list.append(error_log_df)
-        structured_data = pd.concat(structured_data_list, ignore_index=True)
-        error_log_df = pd.concat(error_log_list, ignore_index=True)
+        with self.timed_stage("concat"):
+            structured_data = pd.concat(structured_data_list, ignore_index=True)
+            error_log_df = pd.concat(error_log_list, ignore_index=True)
+        if self.derived_columns and not structured_data.empty:
+            with self.timed_stage("derived_columns"):
+                structured_data = add_derived_columns(structured_data, self.schema.name)
 
         return structured_data, error_log_df
 
-    def _structure_json(self, json_path):
+    def structure_all_jsons_to_parquet(self, output_path, n_jobs=-1, memory_budget_mb=None,
+                                       spill_dir=None):
+        """Structure all json's and write them to a parquet within a memory budget.
+
+        The jsons are sent to the workers only while the observed memory (parent and
+        workers, with psutil) plus the estimate of the jsons in flight (by file size)
+        fits in the budget. Structured results are buffered in the parent and spilled
+        to temporary Arrow IPC files when they pass a share of the budget; the
+        parquet is then written by streaming the spilled batches.
+
+        Parameters
+        ----------
+        output_path: str
+            Path of the structured parquet.
+        n_jobs: int (default=-1, all cores)
+            Maximum number of workers.
+        memory_budget_mb: int (default=None)
+            Memory budget of the extraction. If None, FLIGHT_EXTRACTOR_MEMORY_BUDGET_MB
+            is used and, if it is not set either, structure_all_jsons is used.
+        spill_dir: str (default=None)
+            Folder for the spilled batches. If None, the system temporary folder.
+
+        Return
+        ------
+        error_log_df: pd.DataFrame
+            The log of problems during data structuring.
+        """
+        if memory_budget_mb is None:
+            memory_budget_mb = memory_budget_from_env()
+        if memory_budget_mb is None:
+            structured_data, error_log_df = self.structure_all_jsons(n_jobs=n_jobs)
+            with self.timed_stage("to_parquet"), atomic_path(output_path) as temporary_path:
+                structured_data.to_parquet(temporary_path)
+            return error_log_df
+
+        max_workers = effective_n_jobs(n_jobs)
+        throttle = MemoryThrottle(memory_budget_mb, max_workers)
+        spill_buffer = SpillBuffer(int(throttle.budget_bytes * SPILL_SHARE), spill_dir)
+        executor = get_reusable_executor(max_workers=max_workers)
+        # The workers get a copy without the paths and the measurements already collected
+        worker_extractor = FlightExtractor([], profile=self.profiler is not None,
+                                           cprofile_path=getattr(self.profiler, "cprofile_path", None),
+                                           schema=self.schema)
+        use_cprofile = self.profiler is not None and self.profiler.cprofile_path is not None
+
+        pending_paths = deque(self.json_paths)
+        futures = dict()
+        error_log_list = list()
+        try:
+            while len(pending_paths) > 0 or len(futures) > 0:
+                while len(pending_paths) > 0 and throttle.can_submit(pending_paths[0]):
+                    prefetch_window(self.json_paths, len(self.json_paths) - len(pending_paths))
+                    json_path = pending_paths.popleft()
+                    if self.profiler is None:
+                        future = executor.submit(worker_extractor._structure_json, json_path)
+                    else:
+                        is_first = len(pending_paths) == len(self.json_paths) - 1
+                        future = executor.submit(worker_extractor._structure_json_profiled,
+                                                 json_path, use_cprofile and is_first)
+                    futures[future] = json_path
+                    throttle.submitted(json_path)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    throttle.done(futures.pop(future))
+                    output = future.result()
+                    if self.profiler is not None:
+                        self.profiler.add_file_record(output[2])
+                    structured_data, error_log_df = output[:2]
+                    if self.derived_columns and not structured_data.empty:
+                        structured_data = add_derived_columns(structured_data, self.schema.name)
+                    with self.timed_stage("spill"):
+                        spill_buffer.add(structured_data)
+                    error_log_list.append(error_log_df)
+
+            with self.timed_stage("to_parquet"):
+                spill_buffer.write_parquet(output_path)
+        finally:
+            spill_buffer.cleanup()
+        return pd.concat(error_log_list, ignore_index=True)
+
+    def timed_stage(self, name):
+        """Time a stage of the parent process if profiling is enabled.
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage.
+
+        Return
+        ------
+        context: context manager
+            Timer context of self.profiler, or a no-op context.
+        """
+        if self.profiler is None:
+            return StageTimer(enabled=False).stage(name)
+        return self.profiler.stage(name)
+
+    def _structure_json_profiled(self, json_path, use_cprofile=False):
+        """Structure one json data measuring the time of each stage.
+
+        Parameters
+        ----------
+        json_path: str
+            Json path whose data should be structured.
+        use_cprofile: bool (default=False)
+            If True, run under cProfile and save the statistics in
+            self.profiler.cprofile_path.
+
+        Return
+        ------
+        structured_data: pd.DataFrame
+            Structured json data.
+        error_log_df: pd.DataFrame
+            The log of problems during data structuring.
+        record: dict
+            Measurements of the stages, see StageTimer.to_record.
+        """
+        timer = StageTimer()
+        with timer.stage("total"):
+            if use_cprofile:
+                structured_data, error_log_df = run_with_cprofile(
+                    self.profiler.cprofile_path, self._structure_json, json_path, timer
+                )
+            else:
+                structured_data, error_log_df = self._structure_json(json_path, timer)
+        # "total" is kept apart from the stages so the breakdown adds up
+        total_seconds = timer.stages.pop("total")
+        timer.stages["other"] = max(total_seconds - sum(timer.stages.values()), 0.0)
+        timer.count("rows", len(structured_data))
+        return structured_data, error_log_df, timer.to_record(json_path)
+
+    def _structure_json(self, json_path, timer=None):
         """Structure one json data.
         
         Parameters
         ----------
         json_path: str
             Json path whose data should be structured.
+        timer: StageTimer (default=None)
+            Timer of the stages. If None, nothing is measured.
     
         Return
         ------
@@ -61,38 +251,72 @@ class FlightExtractor():
         error_log_df: pd.DataFrame
             The log of problems during data structuring.
         """
-        data, error_log_df = self._read_json(json_path)
-        data, error_log_df = self._data_checks(data, json_path)
+        if timer is None:
+            timer = StageTimer(enabled=False)
+        with timer.stage("read"):
+            data, error_log_df = self._read_json(json_path)
+        if timer.enabled:
+            timer.count("bytes_read", os.path.getsize(json_path))
+        # A json that could not be read keeps the error log of the reading
+        if data is not None:
+            with timer.stage("data_checks"):
+                data, error_log_df = self._data_checks(data, json_path)
         
         structured_data = pd.DataFrame()
         
         if data is not None:
             try:
-                structured_data_list = list()
-                for flight_info, fare_info in zip(data['legs'], data['offers']):
-
-                    is_the_same_flight = flight_info['legId'] == fare_info['legIds'][0]
-                    if not is_the_same_flight:
-                        continue
-
-                    structured_flight_df = self._structure_flight_information(flight_info)
-                    structured_fare_df = self._structure_fare_information(fare_info)
-                    structured_df = pd.concat(
-                        [structured_flight_df, structured_fare_df], axis="columns"
-                    )
-                    structured_data_list.append(structured_df)
-                structured_data = pd.concat(structured_data_list, ignore_index=True)
-                structured_collect_df = self._structure_collect_information(data, json_path)
-                structured_collect_df = (
-                    structured_collect_df
-                    .loc[structured_collect_df.index.repeat(len(structured_data))]
-                    .reset_index(drop=True)
-                )
-                structured_data = pd.concat([structured_collect_df, structured_data], axis="columns")
+                timer.count("offers", len(data['offers']))
+                structured_data = self._structure_offers_cached(data, timer)
+                with timer.stage("collect_information"):
+                    context = self._structure_collect_information(data, json_path)
+                    for name, value in context.items():
+                        structured_data[name] = value
             except:
                 print("json_path", json_path)
         return structured_data, error_log_df
     
+    def _structure_offers_cached(self, data, timer):
+        """Structure the legs and offers, reusing the result of identical responses.
+
+        Responses stored as blob references carry "blob_ref", the hash of the body.
+        The structured offers of a body only depend on the body, so they are kept in
+        a per-process cache and reused when the same body appears again.
+
+        Parameters
+        ----------
+        data: dict
+            Json data.
+        timer: StageTimer
+            Timer of the stages.
+
+        Return
+        ------
+        structured_data: pd.DataFrame
+            Structured legs and offers. The context columns are empty.
+        """
+        blob_ref = data.get("blob_ref")
+        cache_key = (self.schema.name, blob_ref)
+        if blob_ref is not None and cache_key in _structured_blob_cache:
+            _structured_blob_cache.move_to_end(cache_key)
+            timer.count("blob_cache_hits")
+            return _structured_blob_cache[cache_key].copy()
+
+        with timer.stage("structure_offers"):
+            extract_row = get_extractor(self.schema)
+            context = dict()
+            rows = [extract_row(flight_info, fare_info, context)
+                    for flight_info, fare_info in zip(data['legs'], data['offers'])
+                    if flight_info['legId'] == fare_info['legIds'][0]]
+        with timer.stage("build_dataframe"):
+            structured_data = rows_to_dataframe(rows, self.schema)
+
+        if blob_ref is not None:
+            _structured_blob_cache[cache_key] = structured_data.copy()
+            if len(_structured_blob_cache) > STRUCTURED_BLOB_CACHE_SIZE:
+                _structured_blob_cache.popitem(last=False)
+        return structured_data
+
     def _read_json(self, json_path):
         """Read json.
 
@@ -108,15 +332,23 @@ class FlightExtractor():
         error_log_df: pd.DataFrame
             The log of problems during json reading.
         """
+        error_message = "Unable to read json file"
         try:
-            with open(json_path, 'r') as file:
-                data = json.load(file)
+            data = read_json(json_path)
+            error_message = "Unable to resolve blob reference"
+            data = resolve_blob_reference(data, json_path)
             error_log_df = pd.DataFrame(columns=["json_path", "error_message"])
 
         except json.JSONDecodeError:
             data = None
             error_log_df = pd.DataFrame({"json_path": [json_path],
-                                         "error_message": ["Unable to read json file"]}
+                                         "error_message": [error_message]}
+            )
+        except (OSError, ValueError) as error:
+            # e.g. the blob of a reference is missing or was not copied with the day
+            data = None
+            error_log_df = pd.DataFrame({"json_path": [json_path],
+                                         "error_message": [f"{error_message}: {error}"]}
             )
         return data, error_log_df
     
@@ -160,108 +392,6 @@ class FlightExtractor():
                                              "error_message": [error_message]})
         return data, error_log_df
     
-    def _structure_flight_information(self, flight_info):
-        """Structure flight information.
-        
-         Parameters
-        ----------
-        flight_info: dict
-            The information of each segment of the flight. data['legs']
-        Return
-        ------
-        structured_data_df:pd.DataFrame
-            Structured data
-        """
-        blocked_keys_flight = ['baggageFeesUrl'] + ['segments', 'freeCancellationBy']
-        structured_data_dict = {key: [flight_info.get(key)]
-                                for key in flight_info
-                                if key not in blocked_keys_flight}
-        structured_data_dict['freeCancellationBy'] = [
-            flight_info['freeCancellationBy'].get("raw")
-        ]
-
-        blocked_keys_segments = ["departureTime", "departureTimeEpochSeconds",
-                                 "arrivalTime", "arrivalTimeEpochSeconds",
-                                 "arrivalAirportLocation", "arrivalAirportName",
-                                 "arrivalAirportAddress", "departureAirportLocation",
-                                 "departureAirportName", "departureAirportAddress",
-                                 "airlineImageFileName"]
-        for index, segment in enumerate(flight_info["segments"]):
-            separator = "" if len(flight_info["segments"]) == 1 or index == len(flight_info["segments"]) - 1 else "||"
-            for key, value in segment.items():
-                if key in blocked_keys_segments:
-                    continue
-                value = str(value)
-                if index == 0:
-                    structured_data_dict[key] = [value + separator]
-                else:
-                    structured_data_dict[key] = [structured_data_dict.get(key, [""])[0] + value + separator]
-        structured_data_df = pd.DataFrame(structured_data_dict)
-        return structured_data_df
-    
-    def _structure_fare_information(self, fare_info):
-        """Structure fare information.
-        
-         Parameters
-        ----------
-        fare_info: dict
-            Information about flight fees. data['offers']
-        
-        Return
-        ------
-        structured_data_df:pd.DataFrame
-            Structured data
-        """
-        keys_handled_separately = ["averageTotalPricePerTicket", "segmentAttributes",
-                                   "loyaltyInfo", "flightFulfillmentMethod"]
-        blocked_keys_fare = ["legIds", "baseFarePrice", "totalFarePrice", "totalPrice",
-                             "taxesPrice", "feesPrice", "productKey", "mobileShoppingKey",
-                             "baggageFeesUrl", "fareBasisCodes", "pricePerPassengerCategory"]
-        blocked_keys_fare = blocked_keys_fare + keys_handled_separately
-
-        structured_data_dict = {key: [fare_info.get(key)]
-                                 for key in fare_info
-                                 if key not in blocked_keys_fare}
-
-        structured_data_dict["averageTotalPricePerTicket"] = [
-            fare_info.get("averageTotalPricePerTicket", {}).get("amount")
-        ]
-
-        flightFulfillmentMethod = "||".join(fare_info.get("flightFulfillmentMethod", []))
-        structured_data_dict["flightFulfillmentMethod"] = [
-            None if flightFulfillmentMethod == "" else flightFulfillmentMethod
-        ]
-
-        structured_data_dict["loyaltyInfo_isBurnApplied"] = (
-            fare_info.get("loyaltyInfo", {}).get("isBurnApplied")
-        )
-
-        structured_data_dict["loyaltyInfo_points_base"] = [
-            fare_info.get("loyaltyInfo", {}).get("earn", {}).get('points', {}).get("base")
-        ]
-        structured_data_dict["loyaltyInfo_points_bonus"] = [
-            fare_info.get("loyaltyInfo", {}).get("earn", {}).get('points', {}).get("bonus")
-        ]
-        structured_data_dict["loyaltyInfo_points_total"] = [
-            fare_info.get("loyaltyInfo", {}).get("earn", {}).get('points', {}).get("total")
-        ]
-
-        for index, segment in enumerate(fare_info.get("segmentAttributes", [])):
-            separator = ("" if len(fare_info["segmentAttributes"]) == 1
-                            or index == len(fare_info["segmentAttributes"]) - 1
-                            else "||")
-            for attributes in segment:
-                for key, value in attributes.items():
-                    value = str(value)
-                    if index == 0:
-                        structured_data_dict[key] = [value + separator]
-                    else:
-                        structured_data_dict[key] = [
-                            structured_data_dict[key][0] + value + separator
-                        ]
-        structured_data_df = pd.DataFrame(structured_data_dict)
-        return structured_data_df
-    
     def _structure_collect_information(self, data, json_path):
         """Structure information about data collection.
         
@@ -274,26 +404,33 @@ class FlightExtractor():
 
         Return
         ------
-        structured_data_df:pd.DataFrame
-            Structured data
+        context: dict
+            Value of each context column of the schema.
         """
         json_info_df = extract_info_from_path(json_path)
         operational_search_time = (json_info_df.loc[0, "data_today"] + "T"
                                    + json_info_df.loc[0, "hour"] + ":"
                                    + json_info_df.loc[0, "minute"])
 
-        structured_data_dict = {
-            "search_time": [data.get("search_time")],
-            "operational_search_time":[operational_search_time],
-            "flight_day": [json_info_df.loc[0, "flight_day"]],
+        values = {
+            # KAGGLE_SCHEMA, from the path as in flightextract.py
+            "searchDate": json_info_df.loc[0, "data_today"],
+            "flightDate": json_info_df.loc[0, "flight_day"],
+            "startingAirport": json_info_df.loc[0, "origin"],
+            "destinationAirport": json_info_df.loc[0, "destination"],
+
+            # WIDE_SCHEMA
+            "search_time": data.get("search_time"),
+            "operational_search_time": operational_search_time,
+            "flight_day": json_info_df.loc[0, "flight_day"],
 
-            "origin_code": [data.get("searchCities", [{}])[0].get("code")],
-            "origin_city": [data.get("searchCities", [{}])[0].get("city")],
-            # "origin_country": [data.get('searchCities', [{}])[0].get("country")],
+            "origin_code": data.get("searchCities", [{}])[0].get("code"),
+            "origin_city": data.get("searchCities", [{}])[0].get("city"),
+            # "origin_country": data.get('searchCities', [{}])[0].get("country"),
 
-            "destination_code": [data.get("searchCities", [{}])[-1].get("code")],
-            "destination_city": [data.get("searchCities", [{}])[-1].get("city")],
-            # "destination_country": [data.get('searchCities', [{}])[-1].get("country")],
+            "destination_code": data.get("searchCities", [{}])[-1].get("code"),
+            "destination_city": data.get("searchCities", [{}])[-1].get("city"),
+            # "destination_country": data.get('searchCities', [{}])[-1].get("country"),
         }
-        structured_data_df = pd.DataFrame(structured_data_dict)
-        return structured_data_df
+        return {column.name: values[column.name]
+                for column in self.schema.columns if column.source == "context"}
@@ -1,120 +1,186 @@
+import argparse
+import csv
 import glob
 import json
-import csv
+import os
+from contextlib import ExitStack
+from datetime import date
 
 import tqdm
-import pandas as pd
 import pyarrow
 import pyarrow.parquet
+from atomic_files import atomic_path, write_json_atomic
+from blob_resolver import resolve_blob_reference
+from column_spec import KAGGLE_SCHEMA, compile_schema
+from raw_reader import prefetch_ahead, read_json
 
-filenames = glob.glob('*/*/*.json', recursive = True)
+csv_name = 'itineraries.csv'
+parquet_names = {'GZIP': 'itineraries_gzip.parquet', 'SNAPPY': 'itineraries_snappy.parquet'}
+state_name = 'exported_search_dates.json'
 
-csv_header = None
+chunksize = 100000
 
-csv_name = 'itineraries.csv'
+extract_row = compile_schema(KAGGLE_SCHEMA)
 
-with open(csv_name, 'a', newline = '') as csv_file:
-    for iteration_number, file in enumerate(tqdm.tqdm(filenames)):
-        try:
-            with open(file, 'r') as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            continue
+# Fixed parquet schema, so the files appended by each export have the same columns and types
+arrow_types = {'object': pyarrow.string(), 'int64': pyarrow.int64(),
+               'float64': pyarrow.float64(), 'bool': pyarrow.bool_()}
+parquet_schema = pyarrow.schema([(column.name, arrow_types[column.dtype])
+                                 for column in KAGGLE_SCHEMA.columns])
+
+
+def list_files_by_search_date():
+    """Group the raw files of the current folder (<searchDate>/<flightDate>/<file>.json)."""
+    files_by_search_date = dict()
+    for file in glob.glob('*/*/*.json', recursive = True):
+        searchDate = os.path.normpath(file).split(os.sep)[0]
+        files_by_search_date.setdefault(searchDate, []).append(file)
+    return files_by_search_date
+
+
+def read_state():
+    """Search dates already exported."""
+    if not os.path.isfile(state_name):
+        return {'exported_search_dates': []}
+    with open(state_name, 'r') as f:
+        return json.load(f)
+
+
+def published_search_dates():
+    """Search dates in the published files, for a folder exported before the state existed."""
+    parquet_paths = glob.glob(parquet_names['SNAPPY'].replace('.parquet', '*.parquet'))
+    if len(parquet_paths) > 0:
+        return sorted({searchDate for path in parquet_paths
+                       for searchDate in pyarrow.parquet.read_table(path, columns = ['searchDate'])
+                                                        .column('searchDate').unique().to_pylist()})
+    if os.path.isfile(csv_name):
+        with open(csv_name, 'r', newline = '') as f:
+            return sorted({row['searchDate'] for row in csv.DictReader(f)})
+    return []
+
+
+def write_state(state):
+    write_json_atomic(state_name, state, indent = 1)
+
+
+def extract_entries(file):
+    """Structure the entries of one raw file, in the Kaggle layout."""
+    try:
+        data = resolve_blob_reference(read_json(file), file)
+    except (OSError, ValueError):
+        # Not a json, or a reference whose blob is missing
+        return
+    try:
+        assert len(data['legs']) == len(data['offers']), "legs and offers not same length"
+    except KeyError:
+        return
+    searchDate, flightDate, basename = os.path.normpath(file).split(os.sep)
+    startingAirport, _, destinationAirport = basename.split('.')[0].split('_')
+    context = {
+        'searchDate': searchDate,
+        'flightDate': flightDate,
+        'startingAirport': startingAirport,
+        'destinationAirport': destinationAirport
+    }
+    for flight_info, fare_info in zip(data['legs'], data['offers']):
+        assert flight_info['legId'] == fare_info['legIds'][0], "legIds don't match"
         try:
-            assert len(data['legs']) == len(data['offers']), "legs and offers not same length"
+            assert flight_info['totalTravelDistanceUnits'] == 'mi', "totalTravelDistanceUnits is not 'mi'"
         except KeyError:
-            continue
-        for flight_info, fare_info in zip(data['legs'], data['offers']):
-            assert flight_info['legId'] == fare_info['legIds'][0], "legIds don't match"
-            try:
-                assert flight_info['totalTravelDistanceUnits'] == 'mi', "totalTravelDistanceUnits is not 'mi'"
-            except KeyError:
-                pass
-            assert fare_info['currency'] == 'USD', "currency is not 'USD'"
-            searchDate, flightDate, basename = file.split('\\')
-            startingAirport, _, destinationAirport = basename.split('.')[0].split('_')
-            entry = {
-                'legId': flight_info['legId'],
-                'searchDate': searchDate,
-                'flightDate': flightDate,
-                'startingAirport': startingAirport,
-                'destinationAirport': destinationAirport,
-                'fareBasisCode': flight_info['fareBasisCode'],
-                'travelDuration': flight_info['travelDuration'],
-                'elapsedDays': flight_info['elapsedDays'],
-                'isBasicEconomy': flight_info['isBasicEconomy'],
-                'isRefundable': flight_info['isRefundable'],
-                'isNonStop': flight_info['isNonStop'],
-                'baseFare': fare_info['baseFare'],
-                'totalFare': fare_info['totalFare'],
-                'seatsRemaining': fare_info['seatsRemaining']
-            }
-            try:
-                entry['totalTravelDistance'] = flight_info['totalTravelDistance']
-            except KeyError:
-                entry['totalTravelDistance'] = None
-            assert len(flight_info['segments']) == len(fare_info['segmentAttributes'][0]), "segments and segmentAttributes not same length"
-            departureTimeEpochSeconds = []
-            departureTimeRaw = []
-            arrivalTimeEpochSeconds = []
-            arrivalTimeRaw = []
-            arrivalAirportCode = []
-            departureAirportCode = []
-            airlineName = []
-            airlineCode = []
-            equipmentDescription = []
-            durationInSeconds = []
-            distance = []
-            cabinCode = []
-            for segment, segment_attributes in zip(flight_info['segments'], fare_info['segmentAttributes'][0]):
-                departureTimeEpochSeconds.append(segment['departureTimeEpochSeconds'])
-                departureTimeRaw.append(segment['departureTimeRaw'])
-                arrivalTimeEpochSeconds.append(segment['arrivalTimeEpochSeconds'])
-                arrivalTimeRaw.append(segment['arrivalTimeRaw'])
-                arrivalAirportCode.append(segment['arrivalAirportCode'])
-                departureAirportCode.append(segment['departureAirportCode'])
-                airlineName.append(segment['airlineName'])
-                airlineCode.append(segment['airlineCode'])
-                equipmentDescription.append(segment['equipmentDescription'])
-                durationInSeconds.append(segment['durationInSeconds'])
-                try:
-                    distance.append(segment['distance'])
-                except KeyError:
-                    distance.append(None)
-                cabinCode.append(segment_attributes['cabinCode'])
-            entry['segmentsDepartureTimeEpochSeconds'] = '||'.join(map(str, departureTimeEpochSeconds))
-            entry['segmentsDepartureTimeRaw'] = '||'.join(map(str, departureTimeRaw))
-            entry['segmentsArrivalTimeEpochSeconds'] = '||'.join(map(str, arrivalTimeEpochSeconds))
-            entry['segmentsArrivalTimeRaw'] = '||'.join(map(str, arrivalTimeRaw))
-            entry['segmentsArrivalAirportCode'] = '||'.join(map(str, arrivalAirportCode))
-            entry['segmentsDepartureAirportCode'] = '||'.join(map(str, departureAirportCode))
-            entry['segmentsAirlineName'] = '||'.join(map(str, airlineName))
-            entry['segmentsAirlineCode'] = '||'.join(map(str, airlineCode))
-            entry['segmentsEquipmentDescription'] = '||'.join(map(str, equipmentDescription))
-            entry['segmentsDurationInSeconds'] = '||'.join(map(str, durationInSeconds))
-            entry['segmentsDistance'] = '||'.join(map(str, distance))
-            entry['segmentsCabinCode'] = '||'.join(map(str, cabinCode))
-            if csv_header is None:
-                csv_header = list(entry.keys())
-                csv_writer = csv.DictWriter(csv_file, csv_header)
-                csv_writer.writeheader()
-            else:
-                csv_writer = csv.DictWriter(csv_file, csv_header)
-            csv_writer.writerow(entry)
-
-chunksize = 1000
-csv_stream = pd.read_csv(csv_name, chunksize = chunksize)
-chunk = next(csv_stream)
-parquet_schema = pyarrow.Table.from_pandas(df = chunk).schema
-
-parquet_name = 'itineraries_gzip.parquet'
-csv_stream = pd.read_csv(csv_name, chunksize = chunksize, dtype = chunk.dtypes.to_dict())
-with pyarrow.parquet.ParquetWriter(parquet_name, parquet_schema, compression = 'GZIP') as parquet_writer:
-    for chunk in tqdm.tqdm(csv_stream):
-        parquet_writer.write_table(pyarrow.Table.from_pandas(chunk, schema = parquet_schema))
-
-parquet_name = 'itineraries_snappy.parquet'
-csv_stream = pd.read_csv(csv_name, chunksize = chunksize, dtype = chunk.dtypes.to_dict())
-with pyarrow.parquet.ParquetWriter(parquet_name, parquet_schema, compression = 'SNAPPY') as parquet_writer:
-    for chunk in tqdm.tqdm(csv_stream):
-        parquet_writer.write_table(pyarrow.Table.from_pandas(chunk, schema = parquet_schema))
\ No newline at end of file
+            pass
+        assert fare_info['currency'] == 'USD', "currency is not 'USD'"
+        assert len(flight_info['segments']) == len(fare_info['segmentAttributes'][0]), "segments and segmentAttributes not same length"
+        yield extract_row(flight_info, fare_info, context)
+
+
+def export(filenames, parquet_paths, csv_mode):
+    """Write the entries of the files to the csv and to one parquet per compression.
+
+    The entries are streamed in chunks, so the parquet files are written without
+    reading the csv back.
+    """
+    csv_header = [column.name for column in KAGGLE_SCHEMA.columns]
+    write_header = csv_mode == 'w' or not os.path.isfile(csv_name) or os.path.getsize(csv_name) == 0
+    n_entries = 0
+    with ExitStack() as stack:
+        # Each parquet is renamed into place when the block completes
+        parquet_writers = {compression: stack.enter_context(pyarrow.parquet.ParquetWriter(
+                               stack.enter_context(atomic_path(path)), parquet_schema,
+                               compression = compression))
+                           for compression, path in parquet_paths.items()}
+        # A full export replaces the csv only when it completes; an append is rolled back by the caller
+        csv_path = stack.enter_context(atomic_path(csv_name)) if csv_mode == 'w' else csv_name
+        csv_file = stack.enter_context(open(csv_path, csv_mode, newline = ''))
+        csv_writer = csv.DictWriter(csv_file, csv_header)
+        if write_header:
+            csv_writer.writeheader()
+
+        chunk = []
+        def write_chunk():
+            csv_writer.writerows(chunk)
+            table = pyarrow.Table.from_pylist(chunk, schema = parquet_schema)
+            for parquet_writer in parquet_writers.values():
+                parquet_writer.write_table(table)
+            chunk.clear()
+
+        for file in tqdm.tqdm(prefetch_ahead(filenames), total = len(filenames)):
+            for entry in extract_entries(file):
+                chunk.append(entry)
+                n_entries += 1
+                if len(chunk) >= chunksize:
+                    write_chunk()
+        if len(chunk) > 0:
+            write_chunk()
+
+    return n_entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export the raw data in the Kaggle dataset layout.')
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'only export the search dates that were not exported yet, '
+                               'appending new parquet files next to the published ones')
+    parser.add_argument('--until', default = str(date.today()),
+                        help = 'only export search dates before this one (YYYY-MM-DD); the '
+                               'current day is still being collected')
+    args = parser.parse_args()
+
+    files_by_search_date = list_files_by_search_date()
+    search_dates = sorted(searchDate for searchDate in files_by_search_date if searchDate < args.until)
+    state = read_state()
+
+    if args.incremental:
+        if not os.path.isfile(state_name):
+            # Otherwise the whole history of an existing export would be appended again
+            state['exported_search_dates'] = published_search_dates()
+        search_dates = [searchDate for searchDate in search_dates
+                        if searchDate not in state['exported_search_dates']]
+        if len(search_dates) == 0:
+            print('Nothing new to export')
+            raise SystemExit
+        part_name = f'part-{search_dates[0]}_{search_dates[-1]}'
+        parquet_paths = {compression: path.replace('.parquet', f'.{part_name}.parquet')
+                         for compression, path in parquet_names.items()}
+        csv_mode = 'a'
+    else:
+        state['exported_search_dates'] = []
+        parquet_paths = parquet_names
+        csv_mode = 'w'
+
+    filenames = [file for searchDate in search_dates for file in files_by_search_date[searchDate]]
+    csv_size = os.path.getsize(csv_name) if os.path.isfile(csv_name) else 0
+    try:
+        n_entries = export(filenames, parquet_paths, csv_mode)
+    except BaseException:
+        # Roll the csv back, so a failed export can simply be run again
+        if csv_mode == 'a' and os.path.isfile(csv_name):
+            os.truncate(csv_name, csv_size)
+        raise
+    state['exported_search_dates'] = sorted(set(state['exported_search_dates']) | set(search_dates))
+    write_state(state)
+    if not args.incremental:
+        # The full files now hold every search date, the earlier parts would duplicate them
+        for path in parquet_names.values():
+            for part_path in glob.glob(path.replace('.parquet', '.part-*.parquet')):
+                os.remove(part_path)
+    print(f'Exported {n_entries} entries of {len(search_dates)} search dates to {list(parquet_paths.values())}')
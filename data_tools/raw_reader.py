@@ -0,0 +1,129 @@
+import json
+import mmap
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Files read ahead of the one being structured
+PREFETCH_DISTANCE = 16
+
+
+def loads(buffer):
+    """Parse a json from a byte buffer.
+
+    Parameters
+    ----------
+    buffer: memoryview
+        Bytes of the json, e.g. a view over a memory map.
+
+    Return
+    ------
+    data: dict
+        Parsed json.
+    """
+    if orjson is not None:
+        # Parses the buffer in place, without copying it
+        return orjson.loads(buffer)
+    # The standard library only parses bytes or str, which costs one copy
+    return json.loads(bytes(buffer))
+
+
+def read_json(path, offset=0, length=None):
+    """Read a json through a memory map.
+
+    Parameters
+    ----------
+    path: str
+        Raw file, or archive holding several jsons.
+    offset: int (default=0)
+        Position of the json in the file.
+    length: int (default=None)
+        Size of the json. If None, up to the end of the file.
+
+    Return
+    ------
+    data: dict
+        Parsed json. Empty files raise json.JSONDecodeError, like json.load.
+    """
+    with open(path, 'rb') as file:
+        if length is None:
+            length = os.fstat(file.fileno()).st_size - offset
+        if length <= 0:
+            raise json.JSONDecodeError("Empty file", "", 0)
+        # The map has to start at a multiple of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(file.fileno(), offset - start + length, access=mmap.ACCESS_READ,
+                       offset=start) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as whole, whole[offset - start:] as view:
+                return loads(view)
+
+
+def prefetch(paths):
+    """Ask the kernel to start reading files into the page cache.
+
+    It returns at once; the reads happen in the background while the caller
+    structures the files already read.
+
+    Parameters
+    ----------
+    paths: list[str]
+        Files that will be read soon.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def prefetch_window(paths, index, distance=PREFETCH_DISTANCE):
+    """Keep the files following paths[index] in the read ahead.
+
+    Called once per file in reading order: the first call prefetches the whole
+    window, the next ones only the file entering it.
+
+    Parameters
+    ----------
+    paths: list[str]
+        Files in reading order.
+    index: int
+        Position of the file about to be read.
+    distance: int (default=PREFETCH_DISTANCE)
+        Files read ahead.
+    """
+    if index == 0:
+        prefetch(paths[:distance + 1])
+    elif index + distance < len(paths):
+        prefetch([paths[index + distance]])
+
+
+def prefetch_ahead(paths, distance=PREFETCH_DISTANCE):
+    """Iterate over the files, prefetching the next ones.
+
+    Parameters
+    ----------
+    paths: list[str]
+        Files in reading order.
+    distance: int (default=PREFETCH_DISTANCE)
+        Files read ahead.
+
+    Return
+    ------
+    paths: generator[str]
+        The same files.
+    """
+    for index, path in enumerate(paths):
+        prefetch_window(paths, index, distance)
+        yield path
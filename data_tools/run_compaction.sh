@@ -0,0 +1,2 @@
+source /home/mborges/FlightPrices/setup/FlightPrices/bin/activate
+python /home/mborges/FlightPrices/data_tools/compact_parquet.py
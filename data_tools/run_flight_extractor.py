@@ -4,6 +4,11 @@ from glob import glob
 from os.path import join
 
 import pandas as pd
+import pyarrow.parquet as pq
+from atomic_files import atomic_path
+from bounded_extraction import memory_budget_from_env
+from fare_rollups import SOURCE_COLUMNS as ROLLUP_SOURCE_COLUMNS
+from fare_rollups import update_fare_rollups
 from flight_extractor import FlightExtractor
 from tqdm import tqdm
 
@@ -14,6 +19,8 @@ end_date = start_date
 # end_date = datetime.now()
 
 path_to_save = "/home/mborges/structured_data"
+# Set FLIGHT_EXTRACTOR_MEMORY_BUDGET_MB to extract with bounded memory and spill to disk
+memory_budget_mb = memory_budget_from_env()
 days_path_list = glob('/home/mborges/data/*')
 
 for day_path in tqdm(days_path_list):
@@ -25,11 +32,29 @@ for day_path in tqdm(days_path_list):
     if len(filenames_all) > 0:
         print(f"Structure data of the day {day_str}")
         
-        extractor = FlightExtractor(filenames_all)
-        structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=(64-10))
+        extractor = FlightExtractor(filenames_all, derived_columns=True)
+        structured_path = join(path_to_save, day_str + "_structured_data.parquet")
+        if memory_budget_mb is None:
+            structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=(64-10))
 
-        structured_data.to_parquet(join(path_to_save, day_str + "_structured_data.parquet"))
+            with extractor.timed_stage("to_parquet"), atomic_path(structured_path) as temporary_path:
+                structured_data.to_parquet(temporary_path)
+        else:
+            error_log_df = extractor.structure_all_jsons_to_parquet(
+                structured_path, n_jobs=(64-10), memory_budget_mb=memory_budget_mb
+            )
+            # A day where every json failed has none of the columns
+            columns = [column for column in ROLLUP_SOURCE_COLUMNS
+                       if column in pq.read_schema(structured_path).names]
+            structured_data = pd.read_parquet(structured_path, columns=columns)
+        # The error log is written first, a day where everything failed needs it most
         if not error_log_df.empty:
-            error_log_df.to_parquet(join(path_to_save, "logs", day_str + "_error_log.parquet"))
+            with atomic_path(join(path_to_save, "logs", day_str + "_error_log.parquet")) as temporary_path:
+                error_log_df.to_parquet(temporary_path)
+        with extractor.timed_stage("fare_rollups"):
+            update_fare_rollups(structured_data, join(path_to_save, "rollups"), day_str)
+        if extractor.profiler is not None:
+            print(extractor.profiler.report())
+            extractor.profiler.save(join(path_to_save, "logs", day_str))
         del structured_data
         del error_log_df
\ No newline at end of file
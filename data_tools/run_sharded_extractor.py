@@ -0,0 +1,77 @@
+import argparse
+import sys
+from datetime import datetime, timedelta
+from glob import glob
+from os.path import abspath, dirname, join
+
+from fare_rollups import update_fare_rollups
+from sharded_extraction import (ShardSpec, expected_shard_names, merge_shards, run_local_shards,
+                                structure_shard)
+
+# CoordinateScraper lives with the scraper
+sys.path.append(join(dirname(dirname(abspath(__file__))), "scrape"))
+from coordinate_scraper import CoordinateScraper
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Structure one day of raw data split across the scraping machines."
+    )
+    parser.add_argument("--day", default=str((datetime.now() - timedelta(days=1)).date()),
+                        help="day to structure (YYYY-MM-DD), yesterday by default")
+    parser.add_argument("--data-dir", default="/home/mborges/data",
+                        help="folder with the today_<day> folders")
+    parser.add_argument("--parts-dir", default="/home/mborges/structured_data/parts",
+                        help="folder of the partial parquets")
+    parser.add_argument("--save-dir", default="/home/mborges/structured_data",
+                        help="folder of the merged parquet")
+    parser.add_argument("--n-jobs", type=int, default=-1)
+
+    shard = parser.add_argument_group("shard of this machine")
+    shard.add_argument("--machine-id", type=int,
+                       help="structure the hours CoordinateScraper assigned to this machine")
+    shard.add_argument("--machines-number", type=int, default=3)
+    shard.add_argument("--machines-per-date", type=int, default=2)
+    shard.add_argument("--shard-index", type=int, help="explicit shard of this machine")
+    shard.add_argument("--shard-count", type=int, help="explicit number of shards")
+
+    parser.add_argument("--merge", action="store_true",
+                        help="merge the parts of the day instead of structuring a shard; every "
+                             "shard (--shard-count, else --machines-number) must have its part")
+    parser.add_argument("--local-shards", type=int,
+                        help="simulate this many machines with local processes, then merge")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    day_path = join(args.data_dir, f"today_{args.day}")
+    structured_path = join(args.save_dir, args.day + "_structured_data.parquet")
+    error_log_path = join(args.save_dir, "logs", args.day + "_error_log.parquet")
+
+    if args.merge or args.local_shards is not None:
+        if args.local_shards is not None:
+            filenames_all = glob(join(day_path, "*/*/*.json"))
+            run_local_shards(filenames_all, args.local_shards, args.parts_dir, args.day,
+                             root=args.data_dir, n_jobs=args.n_jobs)
+            shard_names = expected_shard_names(shard_count=args.local_shards)
+        else:
+            # The machines split the day unless an explicit shard count is given
+            shard_names = expected_shard_names(shard_count=args.shard_count,
+                                               machines_number=args.machines_number)
+        structured_data = merge_shards(args.parts_dir, args.day, structured_path, shard_names,
+                                       error_log_path=error_log_path, remove_parts=True)
+        update_fare_rollups(structured_data, join(args.save_dir, "rollups"), args.day)
+        print(f"Merged {len(structured_data)} rows into {structured_path}")
+    else:
+        if args.machine_id is not None:
+            coordinate_scraper = CoordinateScraper(machines_number=args.machines_number,
+                                                   machines_per_date=args.machines_per_date)
+            shard_spec = ShardSpec(coordinate_scraper=coordinate_scraper,
+                                   machine_id=args.machine_id)
+        else:
+            shard_spec = ShardSpec(shard_index=args.shard_index, shard_count=args.shard_count)
+        filenames_all = glob(join(day_path, "*/*/*.json"))
+        part_path = structure_shard(filenames_all, shard_spec, args.parts_dir, args.day,
+                                    root=args.data_dir, n_jobs=args.n_jobs)
+        print(f"Shard {shard_spec.name} written to {part_path}")
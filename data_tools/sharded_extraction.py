@@ -0,0 +1,271 @@
+import os
+import zlib
+from datetime import datetime
+from glob import glob
+from multiprocessing import Process
+from os.path import dirname, isfile, join, relpath
+
+import pandas as pd
+from atomic_files import atomic_path
+from flight_extractor import FlightExtractor
+from map_collected_data import extract_info_from_path
+
+
+# Columns that identify one offer of one search; rows repeated across shards are dropped
+DUPLICATE_KEYS = ["operational_search_time", "flight_day", "origin_code", "destination_code",
+                  "legId"]
+
+PART_PATTERN = "{day}_structured_data.part-{shard}.parquet"
+ERROR_PART_PATTERN = "{day}_error_log.part-{shard}.parquet"
+
+
+class ShardSpec():
+    """Selects the share of the raw files that one machine structures.
+
+    Either by the CoordinateScraper assignment (each machine structures the hours it
+    scraped, which are the files it holds locally) or by an explicit
+    shard_index/shard_count split of the paths.
+    """
+    def __init__(self, shard_index=None, shard_count=None, coordinate_scraper=None,
+                 machine_id=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        shard_index: int (default=None)
+            Index of this shard, 0 <= shard_index < shard_count.
+        shard_count: int (default=None)
+            Total number of shards.
+        coordinate_scraper: CoordinateScraper (default=None)
+            Scraper schedule. If given, the files of the hours assigned to machine_id
+            belong to this shard and shard_index/shard_count are ignored.
+        machine_id: int (default=None)
+            The number that identifies the machine in coordinate_scraper.
+        """
+        if coordinate_scraper is None:
+            assert shard_index is not None and shard_count is not None, (
+                "Give shard_index and shard_count or coordinate_scraper and machine_id")
+            assert 0 <= shard_index < shard_count, (f"shard_index should be in [0, {shard_count}), "
+                                                    f"but shard_index={shard_index}")
+        else:
+            assert machine_id is not None, "machine_id is needed with coordinate_scraper"
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.coordinate_scraper = coordinate_scraper
+        self.machine_id = machine_id
+
+    @property
+    def name(self):
+        """Name of the shard used in the partial file names."""
+        if self.coordinate_scraper is not None:
+            return f"machine{self.machine_id}"
+        return f"{self.shard_index}of{self.shard_count}"
+
+    def contains(self, json_path, root=None):
+        """Checks if a raw file belongs to this shard.
+
+        Parameters
+        ----------
+        json_path: str
+            Path of a raw json.
+        root: str (default=None)
+            With an explicit split, the path is hashed relative to root, so every
+            machine agrees on the split even if the data is mounted elsewhere.
+
+        Return
+        ------
+        contains: bool
+            True if the file should be structured by this shard.
+        """
+        if self.coordinate_scraper is not None:
+            info_df = extract_info_from_path(json_path)
+            search_hour = datetime.strptime(
+                f"{info_df.loc[0, 'data_today']} {info_df.loc[0, 'hour']}", "%Y-%m-%d %H"
+            )
+            return self.coordinate_scraper.check_should_run_hour(search_hour, self.machine_id)
+        key = relpath(json_path, root) if root is not None else json_path
+        return zlib.crc32(key.encode("utf-8")) % self.shard_count == self.shard_index
+
+    def select(self, json_paths, root=None):
+        """Keep the raw files of this shard.
+
+        Parameters
+        ----------
+        json_paths: list[str]
+            Paths of the raw jsons.
+        root: str (default=None)
+            See contains.
+
+        Return
+        ------
+        shard_paths: list[str]
+            Paths that belong to this shard.
+        """
+        return [json_path for json_path in json_paths if self.contains(json_path, root)]
+
+
+def expected_shard_names(shard_count=None, machines_number=None):
+    """Names of every shard of a day, as given by ShardSpec.name.
+
+    Parameters
+    ----------
+    shard_count: int (default=None)
+        Number of shards of an explicit split.
+    machines_number: int (default=None)
+        Number of machines of a CoordinateScraper split, used if shard_count is None.
+
+    Return
+    ------
+    shard_names: list[str]
+        Names of the shards whose parts a merge needs.
+    """
+    if shard_count is not None:
+        return [ShardSpec(shard_index=shard_index, shard_count=shard_count).name
+                for shard_index in range(shard_count)]
+    assert machines_number is not None, "Give shard_count or machines_number"
+    return [f"machine{machine_id}" for machine_id in range(1, machines_number + 1)]
+
+
+def structure_shard(json_paths, shard_spec, output_dir, day_str, root=None, n_jobs=-1,
+                    derived_columns=True):
+    """Structure the share of one machine and write it as a partial parquet.
+
+    Parameters
+    ----------
+    json_paths: list[str]
+        Raw jsons of the day available on this machine.
+    shard_spec: ShardSpec
+        Share of this machine.
+    output_dir: str
+        Directory of the partial parquets (shared or later copied to the merge machine).
+    day_str: str
+        Day (YYYY-MM-DD) being structured.
+    root: str (default=None)
+        See ShardSpec.contains.
+    n_jobs: int (default=-1, all cores)
+        Number of cores used by FlightExtractor.
+    derived_columns: bool (default=True)
+        See FlightExtractor.
+
+    Return
+    ------
+    part_path: str
+        Path of the partial parquet.
+    """
+    shard_paths = shard_spec.select(json_paths, root)
+    extractor = FlightExtractor(shard_paths, derived_columns=derived_columns)
+    if len(shard_paths) > 0:
+        structured_data, error_log_df = extractor.structure_all_jsons(n_jobs=n_jobs)
+    else:
+        structured_data = pd.DataFrame()
+        error_log_df = pd.DataFrame(columns=["json_path", "error_message"])
+
+    os.makedirs(output_dir, exist_ok=True)
+    part_path = join(output_dir, PART_PATTERN.format(day=day_str, shard=shard_spec.name))
+    # Written under a temporary name so the merge never reads an unfinished part
+    if not error_log_df.empty:
+        with atomic_path(join(output_dir, ERROR_PART_PATTERN.format(day=day_str,
+                                                                    shard=shard_spec.name))) as temporary_path:
+            error_log_df.to_parquet(temporary_path)
+    # The part is written last, so a merge that sees it also sees its error log
+    with atomic_path(part_path) as temporary_path:
+        structured_data.to_parquet(temporary_path)
+    return part_path
+
+
+def merge_shards(output_dir, day_str, structured_path, shard_names, error_log_path=None,
+                 remove_parts=False):
+    """Combine the partial parquets of a day and drop duplicated rows.
+
+    The same search can be present in more than one part (e.g. raw files copied
+    between machines); rows with the same DUPLICATE_KEYS are kept once. Nothing is
+    merged or deleted until the part of every shard is present, so a machine that is
+    late or failed does not leave a day with missing searches.
+
+    Parameters
+    ----------
+    output_dir: str
+        Directory of the partial parquets.
+    day_str: str
+        Day (YYYY-MM-DD) to merge.
+    structured_path: str
+        Path of the merged <day>_structured_data.parquet.
+    shard_names: list[str]
+        Names of the shards expected for the day, see expected_shard_names.
+    error_log_path: str (default=None)
+        Path of the merged error log. If None, the error parts are not merged.
+    remove_parts: bool (default=False)
+        If True, delete the parts after the merge.
+
+    Return
+    ------
+    structured_data: pd.DataFrame
+        Merged structured data.
+    """
+    assert len(shard_names) > 0, "shard_names is empty"
+    part_paths = [join(output_dir, PART_PATTERN.format(day=day_str, shard=shard_name))
+                  for shard_name in shard_names]
+    missing_paths = [path for path in part_paths if not isfile(path)]
+    if len(missing_paths) > 0:
+        raise FileNotFoundError(f"Missing {len(missing_paths)} of {len(part_paths)} parts of "
+                                f"{day_str}: {missing_paths}")
+    # The error log is written first, so a failure there leaves the parts in place
+    # and no structured parquet, and the merge can simply be run again
+    error_part_paths = [join(output_dir, ERROR_PART_PATTERN.format(day=day_str, shard=shard_name))
+                        for shard_name in shard_names]
+    # A shard without errors writes no error part
+    error_part_paths = [path for path in error_part_paths if isfile(path)]
+    if error_log_path is not None and len(error_part_paths) > 0:
+        error_log_df = pd.concat([pd.read_parquet(path) for path in error_part_paths],
+                                 ignore_index=True).drop_duplicates(ignore_index=True)
+        os.makedirs(dirname(error_log_path) or ".", exist_ok=True)
+        with atomic_path(error_log_path) as temporary_path:
+            error_log_df.to_parquet(temporary_path)
+
+    structured_data = pd.concat([pd.read_parquet(path) for path in part_paths], ignore_index=True)
+    if not structured_data.empty:
+        structured_data = structured_data.drop_duplicates(subset=DUPLICATE_KEYS, ignore_index=True)
+    with atomic_path(structured_path) as temporary_path:
+        structured_data.to_parquet(temporary_path)
+
+    if remove_parts:
+        for path in part_paths + error_part_paths:
+            os.remove(path)
+    return structured_data
+
+
+def run_local_shards(json_paths, shard_count, output_dir, day_str, root=None, n_jobs=1):
+    """Structure a day with several local processes standing in for machines.
+
+    Parameters
+    ----------
+    json_paths: list[str]
+        Raw jsons of the day.
+    shard_count: int
+        Number of simulated machines.
+    output_dir: str
+        Directory of the partial parquets.
+    day_str: str
+        Day (YYYY-MM-DD) being structured.
+    root: str (default=None)
+        See ShardSpec.contains.
+    n_jobs: int (default=1)
+        Number of cores of each simulated machine.
+
+    Return
+    ------
+    part_paths: list[str]
+        Partial parquets written by the simulated machines.
+    """
+    processes = list()
+    for shard_index in range(shard_count):
+        shard_spec = ShardSpec(shard_index=shard_index, shard_count=shard_count)
+        process = Process(target=structure_shard,
+                          args=(json_paths, shard_spec, output_dir, day_str),
+                          kwargs={"root": root, "n_jobs": n_jobs})
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0, f"A shard failed with exit code {process.exitcode}"
+    return sorted(glob(join(output_dir, PART_PATTERN.format(day=day_str, shard="*"))))
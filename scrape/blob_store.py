@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import tempfile
+from os.path import dirname, isfile, join, relpath
+
+
+class BlobStore():
+    """Content-addressed storage of raw responses.
+
+    Each unique body is stored once in <root>/<aa>/<bb>/<sha256>.json, where the hash
+    covers the raw response bytes as received, so only byte-identical responses share
+    a blob. The file of each search then only keeps a reference to the blob and the
+    search time:
+    {"blob_ref": <sha256>, "blob_path": <path relative to the file>, "search_time": ...}.
+    """
+    def __init__(self, root):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        root: str
+            Directory of the blobs. It must not be inside the "data" folder, so the
+            globs over data/today_*/ do not see the blobs.
+        """
+        self.root = root
+
+    def blob_path(self, digest):
+        """Get the path of a blob.
+
+        Parameters
+        ----------
+        digest: str
+            sha256 of the body.
+
+        Return
+        ------
+        blob_path: str
+            Path of the blob.
+        """
+        return join(self.root, digest[:2], digest[2:4], digest + ".json")
+
+    def digest(self, body):
+        """sha256 of a body, the name of its blob."""
+        return hashlib.sha256(body).hexdigest()
+
+    def reference(self, filename, digest, search_time):
+        """Build the reference file of one search.
+
+        Parameters
+        ----------
+        filename: str
+            Path of the search file.
+        digest: str
+            sha256 of the body.
+        search_time: str
+            Time of the search in ISO format.
+
+        Return
+        ------
+        reference: bytes
+            Content of the search file.
+        """
+        reference = {"blob_ref": digest,
+                     "blob_path": relpath(self.blob_path(digest), dirname(filename)),
+                     "search_time": search_time}
+        return json.dumps(reference).encode("utf-8")
+
+    def put(self, body):
+        """Store a body if it is not stored yet.
+
+        Parameters
+        ----------
+        body: bytes
+            Body to store.
+
+        Return
+        ------
+        digest: str
+            sha256 of the body.
+        blob_path: str
+            Path of the blob.
+        """
+        digest = self.digest(body)
+        blob_path = self.blob_path(digest)
+        if not isfile(blob_path):
+            os.makedirs(dirname(blob_path), exist_ok=True)
+            # Write to a unique temporary file and rename, so a blob is never seen half
+            # written and threads storing the same body do not share the temporary file
+            fd, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=dirname(blob_path))
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(body)
+                os.chmod(temporary_path, 0o644)
+                os.replace(temporary_path, blob_path)
+            except BaseException:
+                try:
+                    os.remove(temporary_path)
+                except FileNotFoundError:
+                    pass
+                raise
+        return digest, blob_path
+
+    def write_reference(self, filename, body, search_time):
+        """Store a body and write the reference file of one search.
+
+        Parameters
+        ----------
+        filename: str
+            Path of the search file, e.g. data/today_*/hour_*/flight_day_*/A_to_B.json.
+        body: bytes
+            Body of the response, without the search_time.
+        search_time: str
+            Time of the search in ISO format.
+
+        Return
+        ------
+        digest: str
+            sha256 of the body.
+        """
+        digest, _ = self.put(body)
+        os.makedirs(dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as file:
+            file.write(self.reference(filename, digest, search_time))
+        return digest
@@ -0,0 +1,382 @@
+import argparse
+import base64
+import json
+import os
+import re
+import sys
+from datetime import date, datetime, time, timedelta
+from os.path import abspath, dirname, isdir, isfile, join
+
+from joblib import Parallel, delayed
+
+from coordinate_scraper import CoordinateScraper
+from flight_scrape import collect_flight_data
+from scrape_daemon import build_airport_pairs, load_config
+
+# The atomic writes are shared with the data tools
+sys.path.append(join(dirname(dirname(abspath(__file__))), "data_tools"))
+from atomic_files import write_json_atomic
+
+
+HOUR_PATTERN = re.compile(r"hour_(\d+)_minute_(\d+)$")
+DAY_HOURS = 24
+
+
+class CoverageBitmap():
+    """One bit per (hour, flight_day, pair) task of a collection day.
+
+    The bits are laid out hour by hour, then flight day (today + 1 ... today +
+    max_additional_day), then pair in the order of airport_pairs, so a day of 24
+    hours, 60 flight days and 70 pairs takes about 12 KB.
+    """
+    def __init__(self, day, airport_pairs, max_additional_day, bits=None):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        day: datetime.date
+            Collection day (the "today" folder).
+        airport_pairs: list[tuple[str, str]]
+            (departure airport, arrival airport) pairs.
+        max_additional_day: int
+            Flight days collected after the collection day.
+        bits: bytearray (default=None)
+            Existing bits. If None, every bit is cleared.
+        """
+        self.day = day
+        self.airport_pairs = [tuple(pair) for pair in airport_pairs]
+        self.max_additional_day = max_additional_day
+        self.pair_index = {pair: index for index, pair in enumerate(self.airport_pairs)}
+        self.n_bits = DAY_HOURS * max_additional_day * len(self.airport_pairs)
+        self.bits = bytearray((self.n_bits + 7) // 8) if bits is None else bytearray(bits)
+
+    def bit_index(self, hour, flight_day, pair):
+        """Position of a task, None if it is outside the bitmap."""
+        additional_day = (flight_day - self.day).days
+        pair_index = self.pair_index.get(tuple(pair))
+        if not 1 <= additional_day <= self.max_additional_day or pair_index is None:
+            return None
+        return ((hour * self.max_additional_day + additional_day - 1) * len(self.airport_pairs)
+                + pair_index)
+
+    def set(self, hour, flight_day, pair):
+        index = self.bit_index(hour, flight_day, pair)
+        if index is not None:
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def set_hour(self, hour):
+        """Set every task of a sweep."""
+        for additional_day in range(1, self.max_additional_day + 1):
+            flight_day = self.day + timedelta(days=additional_day)
+            for pair in self.airport_pairs:
+                self.set(hour, flight_day, pair)
+
+    def difference(self, other):
+        """Bits set here and not in other, e.g. expected minus collected."""
+        bits = bytearray(a & ~b & 0xFF for a, b in zip(self.bits, other.bits))
+        return CoverageBitmap(self.day, self.airport_pairs, self.max_additional_day, bits)
+
+    def count(self):
+        return sum(bin(byte).count("1") for byte in self.bits)
+
+    def tasks(self):
+        """Iterate over the set bits.
+
+        Return
+        ------
+        tasks: generator[tuple[int, datetime.date, tuple[str, str]]]
+            (hour, flight_day, pair) of each set bit.
+        """
+        n_pairs = len(self.airport_pairs)
+        for byte_index, byte in enumerate(self.bits):
+            while byte:
+                low_bit = byte & -byte
+                index = byte_index * 8 + low_bit.bit_length() - 1
+                byte ^= low_bit
+                hour, rest = divmod(index, self.max_additional_day * n_pairs)
+                additional_day, pair_index = divmod(rest, n_pairs)
+                yield (hour, self.day + timedelta(days=additional_day + 1),
+                       self.airport_pairs[pair_index])
+
+    def count_by_hour(self):
+        """Number of set bits of each hour."""
+        counts = [0] * DAY_HOURS
+        for hour, _, _ in self.tasks():
+            counts[hour] += 1
+        return counts
+
+    def to_dict(self):
+        return {"day": str(self.day),
+                "max_additional_day": self.max_additional_day,
+                "airport_pairs": [list(pair) for pair in self.airport_pairs],
+                "bits": base64.b64encode(bytes(self.bits)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(date.fromisoformat(data["day"]), data["airport_pairs"],
+                   data["max_additional_day"], base64.b64decode(data["bits"]))
+
+
+def scheduled_machines(day, coordinate_scraper):
+    """Get the machine scheduled at each hour of a day.
+
+    Parameters
+    ----------
+    day: datetime.date
+        Collection day.
+    coordinate_scraper: CoordinateScraper
+        Schedule of the machines.
+
+    Return
+    ------
+    machines: list[int or None]
+        machine_id that should run the sweep of each hour (the sweeps start at
+        minute 0, see setup/crontab_config.txt).
+    """
+    machines = list()
+    for hour in range(DAY_HOURS):
+        moment = datetime.combine(day, time(hour))
+        machines.append(next((machine_id
+                              for machine_id in range(1, coordinate_scraper.machines_number + 1)
+                              if coordinate_scraper.check_should_run_hour(moment, machine_id)),
+                             None))
+    return machines
+
+
+def expected_bitmap(day, airport_pairs, max_additional_day, hours, now=None):
+    """Tasks that should exist for a collection day.
+
+    Parameters
+    ----------
+    day: datetime.date
+        Collection day.
+    airport_pairs: list[tuple[str, str]]
+        Pairs collected at each sweep.
+    max_additional_day: int
+        Flight days collected after the collection day.
+    hours: list[int]
+        Hours whose sweeps are expected, e.g. the hours scheduled to one machine.
+    now: datetime.datetime (default=None)
+        Current time; the sweeps of the current and later hours are not expected
+        yet. If None, datetime.now().
+
+    Return
+    ------
+    expected: CoverageBitmap
+        Every sweep of those hours that should have run.
+    """
+    if now is None:
+        now = datetime.now()
+    expected = CoverageBitmap(day, airport_pairs, max_additional_day)
+    for hour in hours:
+        if datetime.combine(day, time(hour)) + timedelta(hours=1) <= now:
+            expected.set_hour(hour)
+    return expected
+
+
+def load_index(index_path):
+    if not isfile(index_path):
+        return {"directories": {}}
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+
+def save_index(index, index_path):
+    os.makedirs(dirname(index_path), exist_ok=True)
+    write_json_atomic(index_path, index)
+
+
+def update_index(path, day, index_dir):
+    """Index the files collected on a day, rescanning only the folders that changed.
+
+    The index keeps, for each hour_*/flight_day_* folder, its mtime and the pairs
+    found in it. A folder's mtime changes when a file is added to it, so a day
+    that is no longer being written is listed with one stat per folder.
+
+    Parameters
+    ----------
+    path: str
+        Directory where the data is saved (the "path" of flight_scrape.py).
+    day: datetime.date
+        Collection day.
+    index_dir: str
+        Folder of the persisted indexes.
+
+    Return
+    ------
+    index: dict
+        {"directories": {"<hour folder>/<flight_day folder>": {"mtime_ns": int,
+        "files": [file names]}}}
+    """
+    index_path = join(index_dir, f"index_{day}.json")
+    index = load_index(index_path)
+    day_dir = join(path, "data", f"today_{day}")
+    directories = dict()
+    if isdir(day_dir):
+        with os.scandir(day_dir) as hour_entries:
+            for hour_entry in hour_entries:
+                if not hour_entry.is_dir() or HOUR_PATTERN.match(hour_entry.name) is None:
+                    continue
+                with os.scandir(hour_entry.path) as flight_day_entries:
+                    for flight_day_entry in flight_day_entries:
+                        if not flight_day_entry.is_dir():
+                            continue
+                        key = f"{hour_entry.name}/{flight_day_entry.name}"
+                        mtime_ns = flight_day_entry.stat().st_mtime_ns
+                        cached = index["directories"].get(key)
+                        if cached is not None and cached["mtime_ns"] == mtime_ns:
+                            directories[key] = cached
+                            continue
+                        with os.scandir(flight_day_entry.path) as file_entries:
+                            files = sorted(entry.name for entry in file_entries
+                                           if entry.name.endswith(".json"))
+                        directories[key] = {"mtime_ns": mtime_ns, "files": files}
+    index = {"directories": directories}
+    save_index(index, index_path)
+    return index
+
+
+def collected_bitmap(index, day, airport_pairs, max_additional_day):
+    """Tasks found in the index of a day (any minute of the hour counts)."""
+    collected = CoverageBitmap(day, airport_pairs, max_additional_day)
+    for key, directory in index["directories"].items():
+        hour_name, flight_day_name = key.split("/")
+        hour = int(HOUR_PATTERN.match(hour_name).group(1))
+        flight_day = date.fromisoformat(flight_day_name[len("flight_day_"):])
+        for file_name in directory["files"]:
+            pair = tuple(file_name[:-len(".json")].split("_to_"))
+            collected.set(hour, flight_day, pair)
+    return collected
+
+
+def find_gaps(config, day, machines, now=None):
+    """Compare the expected tasks of a day with the files on disk.
+
+    Each machine only holds the files of its own sweeps, so only the hours that
+    the timesheet gives to config["machine_id"] are expected.
+
+    Parameters
+    ----------
+    config: dict
+        Configuration of the scraper (see scrape_daemon.load_config).
+    day: datetime.date
+        Collection day.
+    machines: list[int or None]
+        Output of scheduled_machines for the day.
+    now: datetime.datetime (default=None)
+        Current time, see expected_bitmap.
+
+    Return
+    ------
+    gaps: CoverageBitmap
+        Expected tasks without a file. It is also saved in <path>/coverage/gaps_<day>.json.
+    expected: CoverageBitmap
+        Expected tasks.
+    """
+    airport_pairs = build_airport_pairs(config["airports"], config["black_list"])
+    index_dir = join(config["path"], "coverage")
+    index = update_index(config["path"], day, index_dir)
+    hours = [hour for hour in range(DAY_HOURS) if machines[hour] == config["machine_id"]]
+    expected = expected_bitmap(day, airport_pairs, config["max_additional_day"], hours, now)
+    collected = collected_bitmap(index, day, airport_pairs, config["max_additional_day"])
+    gaps = expected.difference(collected)
+    write_json_atomic(join(index_dir, f"gaps_{day}.json"), gaps.to_dict())
+    return gaps, expected
+
+
+def print_report(gaps, expected, machine_id):
+    """Print the missing tasks of each hour of the machine."""
+    missing_by_hour = gaps.count_by_hour()
+    expected_by_hour = expected.count_by_hour()
+    print(f"{gaps.day}: {gaps.count()} of {expected.count()} expected tasks of machine "
+          f"{machine_id} missing")
+    for hour in range(DAY_HOURS):
+        if missing_by_hour[hour] == 0:
+            continue
+        # A whole sweep missing means that the machine did not run at all
+        cause = ("sweep missing" if missing_by_hour[hour] == expected_by_hour[hour]
+                 else "tasks given up")
+        print(f"  hour {hour:2d}: {missing_by_hour[hour]:5d}/{expected_by_hour[hour]} missing "
+              f"({cause})")
+
+
+def backfill(gaps, config, n_jobs=8):
+    """Collect the missing tasks that can still be collected.
+
+    Only the gaps of the current collection day whose flight day is in the future
+    are fetched: the files go to the hour folder of the missed sweep, so the
+    collection day in the path stays right, and the search_time in the file
+    records when the response was actually fetched. The gaps of find_gaps only
+    hold the hours of this machine, so other machines' sweeps are never refetched.
+
+    Parameters
+    ----------
+    gaps: CoverageBitmap
+        Output of find_gaps.
+    config: dict
+        Configuration of the scraper.
+    n_jobs: int (default=8)
+        Number of concurrent requests.
+
+    Return
+    ------
+    n_tasks: int
+        Tasks submitted.
+    """
+    today = date.today()
+    if gaps.day != today:
+        return 0
+    # Reuse the minute of the sweep folder when it exists, so an hour stays in one folder
+    day_dir = join(config["path"], "data", f"today_{today}")
+    minutes = dict()
+    if isdir(day_dir):
+        for name in os.listdir(day_dir):
+            match = HOUR_PATTERN.match(name)
+            if match is not None:
+                minutes.setdefault(int(match.group(1)), int(match.group(2)))
+
+    delayed_list = [
+        delayed(collect_flight_data)(
+            today, hour, minutes.get(hour, 0), departure_airport, arrival_airport, flight_day,
+            maxExceptions=config["maxExceptions"], overwrite_data=False, path=config["path"],
+            dedup_blobs=config["dedup_blobs"]
+        )
+        for hour, flight_day, (departure_airport, arrival_airport) in gaps.tasks()
+        if flight_day > today
+    ]
+    if len(delayed_list) > 0:
+        Parallel(n_jobs=n_jobs, prefer="threads", verbose=1)(delayed_list)
+    return len(delayed_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the (hour, flight_day, pair) tasks that were never collected."
+    )
+    parser.add_argument("--config", default=join(dirname(abspath(__file__)),
+                                                 "scrape_config.json"))
+    parser.add_argument("--days", nargs="*", default=None,
+                        help="collection days (YYYY-MM-DD); by default the last 7 days and today")
+    parser.add_argument("--backfill", action="store_true",
+                        help="collect the missing tasks of today whose flight day is in the future")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    coordinate_scraper = CoordinateScraper(machines_number=config["machines_number"],
+                                           machines_per_date=config["machines_per_date"])
+    if args.days:
+        days = [date.fromisoformat(day) for day in args.days]
+    else:
+        days = [date.today() - timedelta(days=days_ago) for days_ago in range(7, -1, -1)]
+
+    for day in days:
+        gaps, expected = find_gaps(config, day, scheduled_machines(day, coordinate_scraper))
+        print_report(gaps, expected, config["machine_id"])
+        if args.backfill:
+            n_tasks = backfill(gaps, config, n_jobs=config["n_jobs"])
+            if n_tasks > 0:
+                print(f"Backfilled {n_tasks} tasks")
+
+
+if __name__ == "__main__":
+    main()
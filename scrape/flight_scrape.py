@@ -1,5 +1,5 @@
 import itertools
-import json
+import threading
 import traceback
 from datetime import date, datetime, timedelta
 from os import makedirs
@@ -9,8 +9,10 @@ from time import sleep, time
 import requests
 from joblib import Parallel, delayed
 
+from blob_store import BlobStore
 from coordinate_scraper import CoordinateScraper
 from log_manager import LogManager
+from raw_writer import AsyncRawWriter, inject_search_time
 
 
 # United States of America airports
@@ -32,10 +34,36 @@ AIRPORTS = ["BSB", "CGH", "GRU", "POA", "CNF", "GIG", "SDU", "SSA", "MAO"]
 AIRPORT_PAIRS = [pair for pair in itertools.product(AIRPORTS, repeat = 2)
                  if pair[0] != pair[1] and pair not in black_list]
 
+# One HTTP session per worker thread, so connections are kept alive between requests
+_thread_local = threading.local()
+
+
+def get_session():
+    """Get the HTTP session of the current thread.
+
+    The session is created on the first call and then reused, which keeps the
+    connections to Expedia open while the worker stays alive.
+
+    Return
+    ------
+    session: requests.Session
+        Session of the current thread.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+def data_filename(path, today, hour, minute, departure_airport, arrival_airport, flight_day):
+    """Path of the file of one search, see collect_flight_data."""
+    return join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}",
+                f"flight_day_{flight_day}", f"{departure_airport}_to_{arrival_airport}.json")
+
 def collect_flight_data(today, hour, minute, departure_airport,
                         arrival_airport, flight_day,
                         maxExceptions=20, overwrite_data=False,
-			path=""):
+			path="", dedup_blobs=False, writer=None):
     """ Air ticket price web scraper.
 
     Collects the data and saves it in json format in the correct folder structure
@@ -59,18 +87,29 @@ def collect_flight_data(today, hour, minute, departure_airport,
         If True overwrite already computed data, if False do not overwrite
     path: str
 	Directory where data should be saved
+    dedup_blobs: bool (default=False)
+        If True, the response is stored once in the content-addressed area
+        <path>/blobs and the file only keeps a reference and the search time
+    writer: AsyncRawWriter (default=None)
+        If given, the files are handed to this background writer instead of being
+        written by the worker. The worker must run in the writer's process
     Return
     ------
     success: bool
         True if the data was successfully collected, False if failure occurred
-        and None if the data had already been computed
+        and None if the data had already been computed. With a writer, True means
+        that the files were queued; the writes that fail are in writer.errors and
+        runner_collect_flight_data collects those searches again
     """
     success = False
     exceptionCounter = 0
     while True:
+        if writer is not None and not writer.thread.is_alive():
+            # The background writer stopped, the files are written directly
+            writer = None
         try:
-            filename = join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}",
-                            f"flight_day_{flight_day}", f"{departure_airport}_to_{arrival_airport}.json")
+            filename = data_filename(path, today, hour, minute, departure_airport,
+                                     arrival_airport, flight_day)
 
             # Checks if the data has already been computed
             if isfile(filename) and not overwrite_data:
@@ -81,17 +120,39 @@ def collect_flight_data(today, hour, minute, departure_airport,
 	    # Read the HTML of the webpage
             URL = (f"https://www.expedia.com/api/flight/search?departureDate={flight_day}"
                    f"&departureAirport={departure_airport}&arrivalAirport={arrival_airport}")
-            request_json = requests.get(URL).json()
+            # The raw bytes are kept, so the response is not decoded and encoded again
+            body = get_session().get(URL).content
 
             # Recording the search time
-            request_json["search_time"] = datetime.now().isoformat()
+            search_time = datetime.now().isoformat()
 
-            # Make directory
-            makedirs(dirname(filename), exist_ok = True)
+            if dedup_blobs:
+                # Identical responses share one blob; the file only points to it
+                if not body.strip().startswith(b"{"):
+                    raise ValueError("The response is not a json object")
+                blob_store = BlobStore(join(path, "blobs"))
+                if writer is None:
+                    blob_store.write_reference(filename, body, search_time)
+                else:
+                    digest = blob_store.digest(body)
+                    blob_path = blob_store.blob_path(digest)
+                    reference = (filename, blob_store.reference(filename, digest, search_time))
+                    if isfile(blob_path):
+                        writer.write(reference)
+                    else:
+                        # One group: the reference is only renamed after its blob
+                        writer.write((blob_path, body), reference)
+            else:
+                # Also checks that the response is a json object
+                body = inject_search_time(body, search_time)
 
-            # Saves the entire web page in json format
-            with open(filename, 'w') as file:
-                json.dump(request_json, file)
+                if writer is None:
+                    makedirs(dirname(filename), exist_ok = True)
+                    # Saves the entire web page in json format
+                    with open(filename, 'wb') as file:
+                        file.write(body)
+                else:
+                    writer.write((filename, body))
 
             print("SUCCESS" + "!"*20)
             success = True
@@ -118,7 +179,8 @@ def collect_flight_data(today, hour, minute, departure_airport,
 
 def runner_collect_flight_data(max_additional_day=60, maxExceptions=20,
                                n_jobs=-1, hour=None, minute=None,
-			       overwrite_data=False, path=""):
+			       overwrite_data=False, path="", airport_pairs=None,
+                               parallel=None, dedup_blobs=False, async_write=False):
     """ Runs collect_flight_data in parallel.
     Parameters
     ----------
@@ -139,7 +201,20 @@ def runner_collect_flight_data(max_additional_day=60, maxExceptions=20,
         If True overwrite already computed data, if False do not overwrite
     path: str
         Directory where data should be saved
+    airport_pairs: list[tuple[str, str]] (default=None)
+        (departure airport, arrival airport) pairs to collect. If None, AIRPORT_PAIRS
+    parallel: joblib.Parallel (default=None)
+        Already started Parallel to run the tasks in, so its workers are reused
+        between calls. If None, a new one is created with n_jobs
+    dedup_blobs: bool (default=False)
+        If True, identical responses are stored only once, see collect_flight_data
+    async_write: bool (default=False)
+        If True, the files are written by a background AsyncRawWriter while the
+        workers keep fetching. The workers then run as threads of this process, so
+        a given parallel must use the threading backend
     """
+    if airport_pairs is None:
+        airport_pairs = AIRPORT_PAIRS
     today = date.today()
     now = datetime.now()
     flight_day_list = [today + timedelta(days = additional_day)
@@ -150,19 +225,51 @@ def runner_collect_flight_data(max_additional_day=60, maxExceptions=20,
     if minute is None:
         minute = now.minute
 
+    writer = None
+    if async_write:
+        writer = AsyncRawWriter()
+        writer.precreate_directories([
+            join(path, "data", f"today_{today}", f"hour_{hour}_minute_{minute}", f"flight_day_{flight_day}")
+            for flight_day in flight_day_list
+        ])
+
     delayed_list = list()
     for flight_day in flight_day_list:
-        for departure_airport, arrival_airport in AIRPORT_PAIRS:
+        for departure_airport, arrival_airport in airport_pairs:
             delayed_list.append(
                 delayed(collect_flight_data)(
                     today, hour, minute, departure_airport,
                     arrival_airport, flight_day,
                     maxExceptions=maxExceptions,
                     overwrite_data=overwrite_data,
-		    path=path
+		    path=path,
+                    dedup_blobs=dedup_blobs,
+                    writer=writer
                 )
             )
-    Parallel(n_jobs=n_jobs , prefer="processes", verbose=1)(delayed_list)
+    if parallel is None:
+        parallel = Parallel(n_jobs=n_jobs, prefer="threads" if async_write else "processes", verbose=1)
+    try:
+        parallel(delayed_list)
+    finally:
+        if writer is not None:
+            errors = writer.close()
+            print(f"{writer.files_written} files written, {len(errors)} write errors")
+
+    if writer is not None and len(errors) > 0:
+        # The searches whose files could not be written are collected again, writing
+        # them directly
+        failed_paths = writer.failed_paths()
+        for flight_day in flight_day_list:
+            for departure_airport, arrival_airport in airport_pairs:
+                filename = data_filename(path, today, hour, minute, departure_airport,
+                                         arrival_airport, flight_day)
+                if filename in failed_paths:
+                    collect_flight_data(today, hour, minute, departure_airport,
+                                        arrival_airport, flight_day,
+                                        maxExceptions=maxExceptions,
+                                        overwrite_data=overwrite_data, path=path,
+                                        dedup_blobs=dedup_blobs)
 
 if __name__ == "__main__":
     path = join("/home","mborges")
@@ -171,6 +278,8 @@ if __name__ == "__main__":
     hour = None
     minute = None
     overwrite_data = False
+    dedup_blobs = False
+    async_write = False
 
     machines_number = 3
     machines_per_date = 2
@@ -183,7 +292,8 @@ if __name__ == "__main__":
     print(f"should_run = {should_run}, start = {now}")
     if should_run:
         runner_collect_flight_data(n_jobs=n_jobs, hour=hour, minute=minute,
-                                   overwrite_data=overwrite_data, path=path)
+                                   overwrite_data=overwrite_data, path=path,
+                                   dedup_blobs=dedup_blobs, async_write=async_write)
         print("Executed!\n\n")
     end = datetime.now()
     print(f"end = {end}")
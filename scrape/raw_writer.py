@@ -0,0 +1,238 @@
+import itertools
+import json
+import os
+import queue
+import threading
+from os.path import dirname
+
+
+_STOP = object()
+
+
+def inject_search_time(body, search_time):
+    """Add the search_time field to a raw json object without decoding it.
+
+    Parameters
+    ----------
+    body: bytes
+        Raw response, a json object.
+    search_time: str
+        Time of the search in ISO format.
+
+    Return
+    ------
+    body: bytes
+        The same object with "search_time" as its first field.
+    """
+    stripped = body.strip()
+    if not (stripped.startswith(b"{") and stripped.endswith(b"}")):
+        raise ValueError("The response is not a json object")
+    field = b'"search_time": ' + json.dumps(search_time).encode("utf-8")
+    rest = stripped[1:].lstrip()
+    if rest.startswith(b"}"):
+        return b"{" + field + b"}"
+    return b"{" + field + b", " + rest
+
+
+def _last_path(group):
+    """Path a group of files is recorded under in the errors."""
+    try:
+        return group[-1][0]
+    except Exception:
+        return repr(group)
+
+
+class AsyncRawWriter():
+    """Writes raw responses to disk in a background thread.
+
+    The fetching workers hand over the bytes and go back to the network while this
+    thread writes the files in batches: each batch is written, fsynced, renamed into
+    place (so a file is never seen half written) and its folders are fsynced once.
+    The workers must share this process, i.e. run as threads.
+
+    Files that could not be written are kept in self.errors; the thread itself
+    keeps running whatever a batch raises.
+    """
+    def __init__(self, batch_size=64, max_queued=1024, fsync=True):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        batch_size: int (default=64)
+            Maximum groups of files written per batch.
+        max_queued: int (default=1024)
+            Maximum groups waiting to be written; write() blocks above it, so a slow
+            disk slows the fetching down instead of growing the memory.
+        fsync: bool (default=True)
+            If True, the files and their folders are fsynced once per batch.
+        """
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.created_directories = set()
+        self.errors = list()
+        self.files_written = 0
+        self._temporary_counter = itertools.count()
+        self.thread = threading.Thread(target=self._run, name="AsyncRawWriter", daemon=True)
+        self.thread.start()
+
+    def precreate_directories(self, directories):
+        """Create the folders of a sweep before it starts.
+
+        Parameters
+        ----------
+        directories: list[str]
+            Folders that will receive files.
+        """
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+            self.created_directories.add(directory)
+
+    def write(self, *files):
+        """Queue a group of files to be written.
+
+        The files of a group are renamed in order and the group stops at the first
+        failure, e.g. a blob and then the reference to it, so a reference is never
+        written without its blob. A failed group is recorded in self.errors under
+        the path of its last file.
+
+        Parameters
+        ----------
+        files: tuple[str, bytes]
+            (path, content) of each file.
+        """
+        self._put(list(files))
+
+    def flush(self):
+        """Wait until every queued file is written."""
+        self.queue.join()
+
+    def close(self):
+        """Write the queued files and stop the thread.
+
+        Return
+        ------
+        errors: list[tuple[str, Exception]]
+            Groups that could not be written, by the path of their last file.
+        """
+        if self.thread.is_alive():
+            self._put(_STOP)
+            self.thread.join()
+        # Anything left in the queue of a dead thread was never written
+        while True:
+            try:
+                group = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if group is not _STOP:
+                self._record_error(_last_path(group), RuntimeError("The writer thread stopped"))
+        return self.errors
+
+    def failed_paths(self):
+        """Paths of the last file of each group that could not be written."""
+        return {path for path, _ in self.errors}
+
+    def _put(self, item):
+        # Fails instead of blocking forever when the queue is full and nobody drains it
+        while True:
+            if not self.thread.is_alive():
+                raise RuntimeError("The writer thread stopped")
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(group is _STOP for group in batch)
+            groups = [group for group in batch if group is not _STOP]
+            try:
+                self._write_batch(groups)
+            except BaseException as error:
+                for group in groups:
+                    self._record_error(_last_path(group), error)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, groups):
+        # Write every file under a temporary name, then fsync and rename group by group
+        opened = list()
+        failed_groups = set()
+        try:
+            for group in groups:
+                group_files = list()
+                opened.append(group_files)
+                try:
+                    for path, body in group:
+                        directory = dirname(path)
+                        if directory not in self.created_directories:
+                            os.makedirs(directory, exist_ok=True)
+                            self.created_directories.add(directory)
+                        temporary_path = f"{path}.{next(self._temporary_counter)}.tmp"
+                        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                        # [fd, temporary path, path, renamed]
+                        group_files.append([fd, temporary_path, path, False])
+                        view = memoryview(body)
+                        while len(view) > 0:
+                            view = view[os.write(fd, view):]
+                except Exception as error:
+                    self._record_error(_last_path(group), error)
+                    failed_groups.add(id(group_files))
+
+            directories = set()
+            for group, group_files in zip(groups, opened):
+                if id(group_files) in failed_groups:
+                    continue
+                try:
+                    for file in group_files:
+                        fd, temporary_path, path, _ = file
+                        if self.fsync:
+                            os.fsync(fd)
+                        file[0] = None
+                        os.close(fd)
+                        os.replace(temporary_path, path)
+                        file[3] = True
+                        directories.add(dirname(path))
+                        self.files_written += 1
+                except Exception as error:
+                    self._record_error(_last_path(group), error)
+
+            if self.fsync:
+                # Makes the renames durable, once per folder of the batch
+                for directory in directories:
+                    try:
+                        fd = os.open(directory, os.O_RDONLY)
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                    except Exception as error:
+                        print(f"Error syncing {directory}: {error}")
+        finally:
+            # Close what is still open and remove what was not renamed
+            for group_files in opened:
+                for fd, temporary_path, _, renamed in group_files:
+                    if fd is not None:
+                        try:
+                            os.close(fd)
+                        except OSError:
+                            pass
+                    if not renamed:
+                        try:
+                            os.remove(temporary_path)
+                        except OSError:
+                            pass
+
+    def _record_error(self, path, error):
+        print(f"Error writing {path}: {error}")
+        self.errors.append((path, error))
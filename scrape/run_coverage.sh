@@ -0,0 +1,3 @@
+# Report the collection gaps of the last days and backfill the ones of today
+source /home/mborges/FlightPrices/setup/FlightPrices/bin/activate
+python /home/mborges/FlightPrices/scrape/coverage.py --backfill
@@ -0,0 +1,3 @@
+# Run webscrape as a resident daemon (replaces the hourly run_scrape.sh cron job)
+source /home/mborges/FlightPrices/setup/FlightPrices/bin/activate
+python /home/mborges/FlightPrices/scrape/scrape_daemon.py
@@ -0,0 +1,310 @@
+import itertools
+import json
+import os
+import signal
+import sys
+import traceback
+from datetime import datetime, timedelta
+from os.path import getmtime, isfile, join
+from time import sleep
+
+from joblib import Parallel
+
+from coordinate_scraper import CoordinateScraper
+from flight_scrape import AIRPORTS, black_list, runner_collect_flight_data
+from log_manager import LogManager
+
+
+DEFAULT_CONFIG = {
+    "path": join("/home", "mborges"),
+    "n_jobs": 8,
+    "prefer": "threads",
+    "max_additional_day": 60,
+    "maxExceptions": 20,
+    "overwrite_data": False,
+    "dedup_blobs": False,
+    # Only used with prefer="threads", the writer lives in the daemon process
+    "async_write": True,
+    "machines_number": 3,
+    "machines_per_date": 2,
+    "machine_id": 1,
+    "airports": AIRPORTS,
+    "black_list": black_list,
+    # Move the daemon log to <path>/logs after each sweep, as the cron job does
+    "rotate_log": True,
+}
+
+
+def load_config(config_path, missing_ok=True):
+    """Load the daemon configuration.
+
+    Parameters
+    ----------
+    config_path: str or None
+        Path to a json whose keys override DEFAULT_CONFIG. If None or the file does
+        not exist, DEFAULT_CONFIG is used.
+    missing_ok: bool (default=True)
+        If False, a config_path that does not exist raises FileNotFoundError.
+
+    Return
+    ------
+    config: dict
+        The configuration.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if config_path is not None and not missing_ok and not isfile(config_path):
+        raise FileNotFoundError(f"{config_path} does not exist")
+    if config_path is not None and isfile(config_path):
+        with open(config_path, 'r') as file:
+            config.update(json.load(file))
+    validate_config(config)
+    return config
+
+
+def validate_config(config):
+    """Checks the daemon configuration before it is used.
+
+    Parameters
+    ----------
+    config: dict
+        The configuration, see DEFAULT_CONFIG.
+
+    Raises
+    ------
+    ValueError
+        If a key is unknown or a value is invalid.
+    """
+    unknown_keys = set(config) - set(DEFAULT_CONFIG)
+    if len(unknown_keys) > 0:
+        raise ValueError(f"Unknown keys {sorted(unknown_keys)}")
+    for key in ["n_jobs", "max_additional_day", "maxExceptions", "machines_number",
+                "machines_per_date", "machine_id"]:
+        if not isinstance(config[key], int) or isinstance(config[key], bool):
+            raise ValueError(f"{key} must be an integer, but {key}={config[key]!r}")
+    for key in ["overwrite_data", "dedup_blobs", "async_write", "rotate_log"]:
+        if not isinstance(config[key], bool):
+            raise ValueError(f"{key} must be true or false, but {key}={config[key]!r}")
+    if not isinstance(config["path"], str):
+        raise ValueError(f"path must be a string, but path={config['path']!r}")
+    if config["n_jobs"] == 0:
+        raise ValueError("n_jobs must not be 0")
+    if config["prefer"] not in ("threads", "processes"):
+        raise ValueError(f"prefer must be 'threads' or 'processes', but prefer={config['prefer']!r}")
+    if not 1 <= config["machines_per_date"] <= config["machines_number"]:
+        raise ValueError(f"machines_per_date must be in [1, machines_number={config['machines_number']}], "
+                         f"but machines_per_date={config['machines_per_date']}")
+    if not 1 <= config["machine_id"] <= config["machines_number"]:
+        raise ValueError(f"machine_id must be in [1, machines_number={config['machines_number']}], "
+                         f"but machine_id={config['machine_id']}")
+    if (not isinstance(config["airports"], list)
+            or not all(isinstance(airport, str) and len(airport) == 3 for airport in config["airports"])):
+        raise ValueError("airports must be a list of three-character IATA codes")
+    if (not isinstance(config["black_list"], list)
+            or not all(isinstance(pair, (list, tuple)) and len(pair) == 2 for pair in config["black_list"])):
+        raise ValueError("black_list must be a list of [departure, arrival] pairs")
+
+
+def build_airport_pairs(airports, black_list):
+    """Build the (departure airport, arrival airport) pairs to collect.
+
+    Parameters
+    ----------
+    airports: list[str]
+        Three-character IATA airport codes.
+    black_list: list[tuple[str, str]]
+        Pairs that should not be collected.
+
+    Return
+    ------
+    airport_pairs: list[tuple[str, str]]
+        All ordered pairs of different airports that are not in black_list.
+    """
+    black_list = {tuple(pair) for pair in black_list}
+    return [pair for pair in itertools.product(airports, repeat=2)
+            if pair[0] != pair[1] and pair not in black_list]
+
+
+class ScrapeDaemon():
+    """Keeps the scraper resident and runs a sweep at each hour assigned to the machine.
+
+    Unlike the hourly cron job, the worker pool (and the HTTP sessions of its
+    workers) stays alive between sweeps and the configuration is reloaded when
+    the config file changes or the process receives SIGHUP.
+    """
+    def __init__(self, config_path=None, poll_seconds=30):
+        """Initialize the class.
+
+        Parameters
+        ----------
+        config_path: str (default=None)
+            Json with the configuration, see load_config.
+        poll_seconds: int (default=30)
+            Maximum time sleeping before checking the clock and the signals again.
+        """
+        self.config_path = config_path
+        self.poll_seconds = poll_seconds
+        self.config = None
+        self.config_mtime = None
+        self.config_from_file = False
+        self.airport_pairs = None
+        self.coordinate_scraper = None
+        self.parallel = None
+        self.last_run = None
+        self.reload_requested = True
+        self.stop_requested = False
+
+    def reload_config_if_changed(self):
+        """Reload the configuration if it changed or a reload was requested.
+
+        An invalid configuration (e.g. a json saved halfway) or a config file that
+        disappeared is reported and the previous one is kept; at startup, with no
+        previous configuration, an invalid one raises.
+
+        Return
+        ------
+        reloaded: bool
+            True if the configuration was reloaded.
+        """
+        mtime = (getmtime(self.config_path)
+                 if self.config_path is not None and isfile(self.config_path) else None)
+        if not self.reload_requested and mtime == self.config_mtime:
+            return False
+        self.config_mtime = mtime
+        self.reload_requested = False
+        try:
+            # Once read from the file, the defaults (e.g. machine_id 1) are never used
+            config = load_config(self.config_path, missing_ok=not self.config_from_file)
+        except (OSError, ValueError) as error:
+            if self.config is None:
+                raise
+            print(f"{datetime.now()} invalid configuration {self.config_path}, "
+                  f"keeping the previous one: {error}")
+            return False
+        old_config = self.config or {}
+        self.config = config
+        self.config_from_file = mtime is not None
+
+        self.airport_pairs = build_airport_pairs(config["airports"], config["black_list"])
+        self.coordinate_scraper = CoordinateScraper(
+            machines_number=config["machines_number"],
+            machines_per_date=config["machines_per_date"]
+        )
+        if (self.parallel is None or old_config.get("n_jobs") != config["n_jobs"]
+                or old_config.get("prefer") != config["prefer"]):
+            self._restart_parallel()
+        print(f"{datetime.now()} configuration loaded: {len(self.airport_pairs)} airport pairs, "
+              f"machine_id = {config['machine_id']}")
+        return True
+
+    def should_run(self, now):
+        """Checks if a sweep should start now.
+
+        Parameters
+        ----------
+        now: datetime.datetime
+            Current date.
+
+        Return
+        ------
+        should_run: bool
+            True if the hour is assigned to this machine and it was not swept yet.
+        """
+        current_hour = now.replace(minute=0, second=0, microsecond=0)
+        if self.last_run == current_hour:
+            return False
+        return self.coordinate_scraper.check_should_run_hour(now, self.config["machine_id"])
+
+    def run_sweep(self, now):
+        """Collect all the tasks of the current hour with the warm worker pool.
+
+        Parameters
+        ----------
+        now: datetime.datetime
+            Date the sweep starts.
+        """
+        self.last_run = now.replace(minute=0, second=0, microsecond=0)
+        print(f"should_run = True, start = {now}")
+        runner_collect_flight_data(max_additional_day=self.config["max_additional_day"],
+                                   maxExceptions=self.config["maxExceptions"],
+                                   hour=now.hour, minute=now.minute,
+                                   overwrite_data=self.config["overwrite_data"],
+                                   path=self.config["path"],
+                                   airport_pairs=self.airport_pairs,
+                                   parallel=self.parallel,
+                                   dedup_blobs=self.config["dedup_blobs"],
+                                   async_write=(self.config["async_write"]
+                                                and self.config["prefer"] == "threads"))
+        print(f"Executed!\nend = {datetime.now()}\n\n")
+        if self.config["rotate_log"]:
+            self._rotate_log(now)
+
+    def run_forever(self):
+        """Run sweeps at the assigned hours until SIGTERM or SIGINT is received."""
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        try:
+            while not self.stop_requested:
+                self.reload_config_if_changed()
+                now = datetime.now()
+                if self.should_run(now):
+                    # A failed sweep must not end the daemon, it only restarts at reboot
+                    try:
+                        self.run_sweep(now)
+                    except Exception:
+                        traceback.print_exc()
+                        print(f"Sweep failed!\nend = {datetime.now()}\n\n")
+                    continue
+                self._sleep_until_next_hour()
+        finally:
+            self._stop_parallel()
+
+    def _rotate_log(self, now):
+        # The daemon writes to log_scrape_daemon.txt through stdout (see crontab_config.txt)
+        log_path = join(self.config["path"], "FlightPrices", "scrape", "log_scrape_daemon.txt")
+        if not isfile(log_path):
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            LogManager(execution_date=now, log_path=log_path,
+                       logs_folder=join(self.config["path"], "logs")).rename_and_move()
+            # stdout still points to the moved file, so it is reopened on a new one
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+        except OSError as error:
+            print(f"Error rotating {log_path}: {error}")
+
+    def _sleep_until_next_hour(self):
+        now = datetime.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        seconds = (next_hour - now).total_seconds()
+        sleep(max(min(seconds, self.poll_seconds), 0))
+
+    def _restart_parallel(self):
+        self._stop_parallel()
+        # Entering the context starts the pool once; it is reused by every sweep.
+        # Threads are the default because the tasks wait on the network and, unlike
+        # loky processes, they are not shut down when idle between sweeps.
+        self.parallel = Parallel(n_jobs=self.config["n_jobs"], prefer=self.config["prefer"],
+                                 verbose=1)
+        self.parallel.__enter__()
+
+    def _stop_parallel(self):
+        if self.parallel is not None:
+            self.parallel.__exit__(None, None, None)
+            self.parallel = None
+
+    def _request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def _request_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+if __name__ == "__main__":
+    config_path = join("/home", "mborges", "FlightPrices", "scrape", "scrape_config.json")
+    daemon = ScrapeDaemon(config_path=config_path)
+    daemon.run_forever()